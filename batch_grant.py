@@ -2,13 +2,9 @@
 
 from sys import exit
 
-from sqlalchemy.exc import IntegrityError
+from hades.access import AccessError, all_events, grant_access
 
-from hades import db
-from hades.models.user import Users
-from hades.models.user_access import Access
-
-tables = db.engine.table_names()
+tables = all_events()
 print(tables)
 table = input(f'Enter table name: ')
 if table not in tables:
@@ -16,28 +12,19 @@ if table not in tables:
     exit(1)
 
 print('Keep entering usernames, ctrl c/d to exit!')
-users = []
+usernames = []
 try:
     while True:
-        username = input('Enter username: ')
-        user = db.session.query(Users).get(username)
-        if user is None:
-            print(f'User {username} does not seem to exist!')
-            exit(1)
-        users.append(user)
+        usernames.append(input('Enter username: '))
 except EOFError:
     pass
 except KeyboardInterrupt:
     pass
 
-for user in users:
-    username = user.username
-    access = Access(event=table, user=username)
-    db.session.add(access)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        print(f'User {username} already seems to have access to {table}!')
-        db.session.rollback()
-        continue
-    print(f'Granted access on {table} to {username}')
+# Every user is checked, and access granted, in one go
+try:
+    count = grant_access({(username, table) for username in usernames})
+except AccessError as e:
+    print(e)
+    exit(1)
+print(f'Granted access on {table} to {count} users, the rest had it already')
@@ -1,17 +1,64 @@
 #!/usr/bin/env python3
 
+from sqlalchemy import inspect, text
+
 from hades import db
+from hades.db_utils import UNTRACKED_TABLES, bump_versions, commit_transaction
+from hades.models.contact import Contact
 from hades.models.event import Events
+from hades.models.phone_number import PhoneNumber
+from hades.models.validate import ValidateMixin
+from hades.utils import DATABASE_CLASSES
 
+# Every model has to be imported for its table to be created
+DATABASE_CLASSES.import_models()
 db.create_all()
 
+# Add the columns which were added to the `events` table after it was created
+columns = [column['name'] for column in inspect(db.engine).get_columns('events')]
+with db.engine.begin() as connection:
+    if 'fields' not in columns:
+        connection.execute(text('ALTER TABLE events ADD COLUMN fields TEXT'))
+        print('Added column fields to events')
+    if 'active' not in columns:
+        connection.execute(
+            text('ALTER TABLE events ADD COLUMN active BOOLEAN NOT NULL DEFAULT FALSE')
+        )
+        # The event which used to be hard-coded as the active one
+        connection.execute(
+            text("UPDATE events SET active = TRUE WHERE name = 'coursera_2020'")
+        )
+        print('Added column active to events')
+if 'active' not in columns:
+    # Workers which are running already read the active event again
+    bump_versions({'events'})
+    commit_transaction()
+
+# Build the events which are defined by a schema in the `events` table, creating their tables
+DATABASE_CLASSES.load_all()
+
 for table in db.engine.table_names():
+    # Internal tables aren't events
+    if table in UNTRACKED_TABLES:
+        continue
     current_event = db.session.query(Events).get(table)
     if current_event is None:
         full_name = input(f'Enter full name for table {table}: ')
         new_event = Events(name=table, full_name=full_name)
         db.session.add(new_event)
-        db.session.commit()
+        commit_transaction()
         print(f'Added event {table} with full name {full_name}')
     else:
         print(f'Found table {current_event.name} - {current_event.full_name}')
+
+# Index the phone numbers of registrations which were made before the `phone_numbers` table existed
+for table in DATABASE_CLASSES.values():
+    if issubclass(table, ValidateMixin) and hasattr(table, 'phone'):
+        PhoneNumber.rebuild(table)
+        print(f'Indexed phone numbers of {table.__tablename__}')
+
+# List the registrations which were made before the `contacts` table existed in the directory
+for table in DATABASE_CLASSES.values():
+    if all(hasattr(table, column) for column in ('id', 'name', 'phone')):
+        Contact.rebuild(table)
+        print(f'Listed contacts of {table.__tablename__}')
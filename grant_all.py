@@ -1,28 +1,13 @@
 #!/usr/bin/env python3
 
-from sys import stdin, stdout, exit
+from sys import exit
 
-from sqlalchemy.exc import IntegrityError
+from hades.access import AccessError, all_events, grant_access
 
-from hades import db
-from hades.models.user import Users
-from hades.models.user_access import Access
-
-
-tables = db.engine.table_names()
 username = input(f'Enter username that needs access to all tables: ')
-user = Users.query.get(username)
-if user is None:
-    print(f'User {username} does not seem to exist!')
+try:
+    count = grant_access({(username, event) for event in all_events()})
+except AccessError as e:
+    print(e)
     exit(1)
-
-for table in tables:
-    access = Access(event=table, user=username)
-    db.session.add(access)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        print(f'User {username} already seems to have access to {table}!')
-        db.session.rollback()
-        continue
-    print(f'Granted access on {table} to {username}')
+print(f'Granted access on {count} tables to {username}, the rest were granted already')
@@ -9,7 +9,7 @@ from datetime import datetime
 from urllib.parse import urlparse, urljoin
 
 from decouple import config
-from flask import Flask, redirect, render_template, url_for, jsonify, abort
+from flask import Flask, g, redirect, render_template, url_for, jsonify, abort
 from flask_login import (
     LoginManager,
     login_required,
@@ -33,6 +33,8 @@ from .db_utils import *
 
 from .utils import *
 
+from .auth import credential_cache, find_token
+
 from . import api
 
 # Import event related classes
@@ -41,13 +43,12 @@ from . import api
 from .models.user import Users, TSG
 from .models.user_access import Access
 
-# A list of currently active events
-ACTIVE_TABLES = [models.giveaway.Coursera2020]
-ACTIVE_EVENTS = ['Coursera 2020']
-
 # The list of fields that will be required for any and all form submissions
 REQUIRED_FIELDS = ('name', 'phone', 'email')
 
+# Number of registrations shown per page on the events page
+EVENTS_PAGE_SIZE = config('EVENTS_PAGE_SIZE', default=500, cast=int)
+
 
 def is_safe_url(target: str) -> bool:
     """Returns whether or not the target URL is safe or a malicious redirect"""
@@ -66,17 +67,34 @@ def load_user(user_id):
 def load_user_from_request(request):
     """Checks for authorization in a request
 
-    The request can contain one of 2 headers
+    The request can contain one of 3 headers
+    -> Authorization: Bearer api_token
+    or
     -> Credentials: base64(username|password)
     or
-    -> Authorization: api_token
+    -> Authorization: base64(username|password)
 
-    It first checks for the `Credentials` header, and then for `Authorization`
+    API tokens are checked first, and then the `Credentials` header and `Authorization`
     If they match any user in the database, that user is logged into that session
     """
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        api_token = find_token(authorization[len('Bearer ') :].strip())
+        if api_token is None:
+            return None
+        user = get_user(Users, api_token.username)
+        if user is None:
+            return None
+        # Checked by `utils.check_access()` and `utils.get_accessible_tables()`
+        g.token_scope = api_token.scope
+        log(
+            f'User <code>{user.name}</code> just authenticated a {request.method} API call with token <code>{api_token.name}</code>!',
+        )
+        return user
+
     credentials = request.headers.get('Credentials')
     if not credentials:
-        credentials = request.headers.get('Authorization')
+        credentials = authorization
         if not credentials:
             return None
 
@@ -87,10 +105,15 @@ def load_user_from_request(request):
         credentials = base64.b64decode(credentials).decode('utf-8')
     except (UnicodeDecodeError, binascii.Error):
         return None
-    username, password = credentials.split('|')
+    username, _, password = credentials.partition('|')
     user = get_user(Users, username)
     if user:
-        if user.check_password_hash(password.strip()):
+        # Clients sending credentials on every call only pay for bcrypt once in a while
+        verified = credential_cache.get(credentials, user.password)
+        if verified or user.check_password_hash(password.strip()):
+            if not verified:
+                rehash_password(user, password.strip())
+            credential_cache.put(credentials, user.password)
             log(
                 f'User <code>{user.name}</code> just authenticated a {request.method} API call with credentials!',
             )
@@ -116,7 +139,7 @@ def submit():
     db -> The name of the database corresponding to the event. This will be hardcoded as an invisible uneditable field
     event -> The name of the event
 
-    These fields can be skipped if ACTIVE_TABLES and ACTIVE_EVENTS lists have only one element
+    These fields can be skipped if only one event is marked active in the `events` table
     This is done as we usually don't have more than 1 event at one time, we can reduce the risk of data being changed
     at the frontend by directly setting it here in the backend
 
@@ -148,13 +171,18 @@ def submit():
     Based on the data, a QR code is generated, displayed, and also emailed to the user(s).
     """
 
+    # Events taking registrations, which can be changed in the `events` table without a restart
+    active = DATABASE_CLASSES.active()
+    active_tables = [table for table, _ in active]
+    active_events = [full_name for _, full_name in active]
+
     # If there's just one active table, no need of checking
-    if len(ACTIVE_TABLES) == 1:
-        table = ACTIVE_TABLES[0]
+    if len(active_tables) == 1:
+        table = active_tables[0]
     elif 'db' in request.form:
         table = get_table_by_name(request.form['db'])
         # Ensure that the provided table is active
-        if table not in ACTIVE_TABLES:
+        if table not in active_tables:
             log(
                 f"Someone just tried to register to table <code>{request.form['db']}</code>"
             )
@@ -167,8 +195,8 @@ def submit():
         return "You need to specify a database!"
 
     # If we have only one active event - we know the event name already
-    if len(ACTIVE_EVENTS) == 1:
-        event_name = ACTIVE_EVENTS[0]
+    if len(active_events) == 1:
+        event_name = active_events[0]
     elif 'event' in request.form:
         event_name = request.form['event']
     else:
@@ -179,14 +207,14 @@ def submit():
         if field not in request.form:
             return f'<code>{field}</code> is required but has not been submitted!'
 
-    # ID is from a helper function that increments the latest ID by 1 and returns it
+    # ID is reserved by a helper function up front, so it can be used in the email and QR code before inserting
     id_ = get_current_id(table)
 
     data = {}
 
     # Ensure that we only take in valid fields to create our user object
     for k, v in request.form.items():
-        if k in table.__table__.columns._data.keys():
+        if k in table.__table__.columns.keys():
             data[k] = v
 
     # Instantiate our user object based on the received form data and retrived ID
@@ -222,17 +250,7 @@ def submit():
 
     # Generate the QRCode based on the given data and store base64 encoded version of it to email
     if 'no_qr' not in request.form:
-        img = generate_qr(user)
-        img.save('qr.png')
-        img_data = open('qr.png', 'rb').read()
-        encoded = base64.b64encode(img_data).decode()
-
-    # Add the user to the database and commit the transaction, ensuring no integrity errors.
-    success, reason = insert(user)
-    if not success:
-        log(f'Could not insert user {user}')
-        log(reason)
-        return """It appears there was an error while trying to enter your data into our database.<br/>Kindly contact someone from the team and we will have this resolved ASAP"""
+        encoded = base64.b64encode(generate_qr(user)).decode()
 
     # Prepare the email sending
     from_email = config('FROM_EMAIL', default='noreply@thescriptgroup.in')
@@ -293,9 +311,6 @@ You're <b>required</b> to present this on the day of the event."""
             }
         )
 
-    # Send the mail
-    mail_sent = send_mail(from_email, to_emails, subject, message, attachments)
-
     # Log the new entry to desired telegram channel
     chat_id = (
         request.form['chat_id'] if 'chat_id' in request.form else config('GROUP_ID')
@@ -304,18 +319,30 @@ You're <b>required</b> to present this on the day of the event."""
     if 'extra_field_telegram' in request.form:
         caption += f" | {request.form['extra_field_telegram']} - {request.form[request.form['extra_field_telegram']]}"
 
-    tg.send_chat_action(chat_id, 'typing')
-    tg.send_message(chat_id, f'New registration for {event_name}!')
-    if 'no_qr' not in request.form:
-        tg.send_document(chat_id, caption, 'qr.png')
+    # The mail and the Telegram notifications are sent by `hades.worker`, we only queue them here
+    messages = [f'New registration for {event_name}!']
+    if 'no_qr' in request.form:
+        notification = queue_telegram(chat_id, messages + [caption])
     else:
-        tg.send_message(chat_id, caption)
+        notification = queue_telegram(
+            chat_id, messages, caption=caption, document=encoded
+        )
+    objects = [
+        user,
+        queue_mail(from_email, to_emails, subject, message, attachments),
+        notification,
+    ]
+
+    # Add the user and the queued notifications to the database in a single transaction, ensuring no integrity errors.
+    success, reason = insert(objects)
+    if not success:
+        log(f'Could not insert user {user}')
+        log(reason)
+        return """It appears there was an error while trying to enter your data into our database.<br/>Kindly contact someone from the team and we will have this resolved ASAP"""
 
     ret = f'Thank you for registering, {user.name}!'
     if 'no_qr' not in request.form:
-        ret += "<br>Please save this QR Code. "
-        if mail_sent:
-            ret += "It has also been emailed to you."
+        ret += "<br>Please save this QR Code. It will also be emailed to you shortly."
         ret += "<br><img src=\
                 'data:image/png;base64, {}'/>".format(
             encoded
@@ -342,6 +369,7 @@ def login():
             password = request.form['password']
             # Check the password against the hash stored in the database
             if user.check_password_hash(password):
+                rehash_password(user, password)
                 # Log the login and redirect
                 log(f'User <code>{user.name}</code> logged in via webpage!')
                 login_user(user)
@@ -428,9 +456,15 @@ def events():
         log(
             f"User <code>{current_user.name}</code> is accessing <code>{request.form['table']}</code>!"
         )
-        user_data = get_data_from_table(table)
+        user_data, next_id = select_users(
+            table, after_id=request.form.get('after_id'), limit=EVENTS_PAGE_SIZE
+        )
         return render_template(
-            'users.html', users=user_data, columns=table.__table__.columns._data.keys()
+            'users.html',
+            users=user_data,
+            columns=table.__table__.columns.keys(),
+            table_name=table_name,
+            next_id=next_id,
         )
     return render_template('events.html', events=get_accessible_tables())
 
@@ -1,4 +1,139 @@
+"""
+Command line interface of the application
+
+    python -m hades             runs the development server
+    python -m hades clone URL   copies the database of the application into another one
+    python -m hades sync URL    brings a copy of the database up to date
+    python -m hades access      grants or revokes access to events in bulk
+"""
+
+import argparse
+import sys
+
 from hades import app
+from hades.access import (
+    AccessError,
+    all_events,
+    grant_access,
+    read_grants,
+    revoke_access,
+)
+from hades.clone import CLONE_CHUNK_SIZE, CLONE_WORKERS, CloneError, clone_database
+from hades.sync import sync_database
 
-if __name__ == '__main__':
+
+def run(args):
     app.run()
+
+
+def clone(args):
+    tables = args.tables.split(',') if args.tables else None
+    try:
+        clone_database(args.dest, args.source, tables, args.chunk_size, args.workers)
+    except CloneError as e:
+        print(e)
+        return 1
+    return 0
+
+
+def sync(args):
+    tables = args.tables.split(',') if args.tables else None
+    try:
+        matched = sync_database(
+            args.dest, args.source, tables, args.chunk_size, args.workers, args.check
+        )
+    except CloneError as e:
+        print(e)
+        return 1
+    return 0 if matched else 1
+
+
+def access(args):
+    grants = set()
+    if args.users and args.events:
+        events = args.events.split(',')
+        if events == ['all']:
+            events = all_events()
+        grants.update(
+            (username, event) for username in args.users.split(',') for event in events
+        )
+    if args.csv:
+        grants.update(read_grants(args.csv))
+    if not grants:
+        print('Nothing to do, pass --users and --events, or --csv')
+        return 1
+    try:
+        if args.action == 'grant':
+            count = grant_access(grants)
+            print(f'Granted {count} of {len(grants)}, the rest existed already')
+        else:
+            count = revoke_access(grants)
+            print(f'Revoked {count} of {len(grants)}, the rest did not exist')
+    except AccessError as e:
+        print(e)
+        return 1
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='hades')
+    parser.set_defaults(func=run)
+    commands = parser.add_subparsers(title='commands')
+
+    commands.add_parser('run', help='Run the development server').set_defaults(func=run)
+
+    # Arguments shared by the commands copying the database
+    copying = argparse.ArgumentParser(add_help=False)
+    copying.add_argument('dest', help='URL of the database to copy to')
+    copying.add_argument(
+        '--source', help='URL of the database to copy from, defaults to DATABASE_URL'
+    )
+    copying.add_argument(
+        '--tables', help='Comma separated names of the tables to copy, defaults to all'
+    )
+    copying.add_argument(
+        '--chunk-size',
+        type=int,
+        default=CLONE_CHUNK_SIZE,
+        help='Number of rows read and written at a time',
+    )
+    copying.add_argument(
+        '--workers',
+        type=int,
+        default=CLONE_WORKERS,
+        help='Number of tables copied in parallel',
+    )
+
+    commands.add_parser(
+        'clone', parents=[copying], help='Copy the database into another one'
+    ).set_defaults(func=clone)
+
+    parser_sync = commands.add_parser(
+        'sync', parents=[copying], help='Bring a copy of the database up to date'
+    )
+    parser_sync.add_argument(
+        '--check',
+        action='store_true',
+        help='Only compare checksums of the tables, exiting with 1 if any differ',
+    )
+    parser_sync.set_defaults(func=sync)
+
+    parser_access = commands.add_parser(
+        'access', help='Grant or revoke access to events in bulk'
+    )
+    parser_access.add_argument('action', choices=('grant', 'revoke'))
+    parser_access.add_argument('--users', help='Comma separated usernames')
+    parser_access.add_argument(
+        '--events', help='Comma separated names of events, or all of them with all'
+    )
+    parser_access.add_argument(
+        '--csv', help='CSV file with a username and an event on every line'
+    )
+    parser_access.set_defaults(func=access)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
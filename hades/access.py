@@ -0,0 +1,193 @@
+"""
+Granting and revoking access to events in bulk, for `python -m hades access`
+
+Users and events are each checked with a single query, and all grants are then written with a single statement (one
+per chunk on Postgres), in one transaction. Grants which exist already are left alone, so granting the same access
+twice is harmless
+"""
+
+import csv
+
+from decouple import config
+from sqlalchemy import select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+from hades import db
+from hades.db_utils import change_row_counts, commit_transaction, record_table_changes
+from hades.models.event import Events
+from hades.models.user import Users
+from hades.models.user_access import Access
+
+# Number of grants inserted by a statement on Postgres, which returns the grants it inserted
+GRANT_CHUNK_SIZE = config('GRANT_CHUNK_SIZE', default=1000, cast=int)
+
+
+class AccessError(Exception):
+    """Raised when access can't be granted or revoked, before anything was written"""
+
+
+def read_grants(path: str) -> set:
+    """
+    Function to read grants from a CSV file with a username and an event on every line, and an optional header
+    :param path: Path to the file
+    :return: Set of (username, event) tuples
+    """
+    grants = set()
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            row = [column.strip() for column in row]
+            if len(row) < 2 or not row[0] or row[0] in ('user', 'username'):
+                continue
+            grants.add((row[0], row[1]))
+    return grants
+
+
+def all_events() -> list:
+    """Returns the names of all events"""
+    return db.session.execute(select(Events.name)).scalars().all()
+
+
+def validate(grants: set):
+    """
+    Function to check that the users and events of the given grants exist
+    :param grants: Set of (username, event) tuples
+    :raises AccessError: naming every user and event which doesn't exist
+    """
+    usernames = {username for username, _ in grants}
+    events = {event for _, event in grants}
+    known_users = db.session.execute(
+        select(Users.username).where(Users.username.in_(usernames))
+    ).scalars()
+    known_events = db.session.execute(
+        select(Events.name).where(Events.name.in_(events))
+    ).scalars()
+    errors = []
+    missing = usernames - set(known_users)
+    if missing:
+        errors.append(f'Users {", ".join(sorted(missing))} do not exist')
+    missing = events - set(known_events)
+    if missing:
+        errors.append(f'Events {", ".join(sorted(missing))} do not exist')
+    if errors:
+        raise AccessError('\n'.join(errors))
+
+
+def existing_grants(grants: set, lock: bool = False) -> set:
+    """
+    Function to find which of the given grants have been made already
+    :param grants: Set of (username, event) tuples
+    :param lock: Whether to lock them until the transaction ends, so that nobody else can add or remove them
+    :return: Set of the (username, event) tuples which exist
+    """
+    access = Access.__table__
+    query = select(access.c.user, access.c.event).where(
+        tuple_(access.c.user, access.c.event).in_(sorted(grants))
+    )
+    if lock:
+        query = query.with_for_update()
+    return {(username, event) for username, event in db.session.execute(query)}
+
+
+def insert_ignore(table):
+    """Returns an insert into the given table which skips rows whose primary key exists already"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert().prefix_with('IGNORE')
+
+
+def insert_grants(grants: list) -> set:
+    """
+    Function to insert grants, skipping those which exist already, as part of the current transaction
+    :param grants: List of (username, event) tuples, none of which existed when they were locked
+    :return: Set of the (username, event) tuples which were inserted
+    """
+    access = Access.__table__
+    rows = [{'user': username, 'event': event} for username, event in grants]
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+
+        # The rows skipped are told apart by those returned, a multi-row INSERT per chunk as executemany can't return
+        inserted = set()
+        for i in range(0, len(rows), GRANT_CHUNK_SIZE):
+            inserted.update(
+                (username, event)
+                for username, event in db.session.execute(
+                    insert(access)
+                    .values(rows[i : i + GRANT_CHUNK_SIZE])
+                    .on_conflict_do_nothing()
+                    .returning(access.c.user, access.c.event)
+                )
+            )
+        return inserted
+    db.session.execute(insert_ignore(access), rows)
+    # Nobody else could add these while they are locked, so the ones found now were inserted here
+    return existing_grants(set(grants))
+
+
+def grant_access(grants: set) -> int:
+    """
+    Function to grant access to events
+    :param grants: Set of (username, event) tuples
+    :return: The number of grants which didn't exist yet
+    :raises AccessError: if a user or event doesn't exist, or the grants couldn't be written
+    """
+    if not grants:
+        return 0
+    validate(grants)
+    new = sorted(grants - existing_grants(grants, lock=True))
+    if not new:
+        db.session.rollback()
+        return 0
+    try:
+        inserted = insert_grants(new)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        raise AccessError(f'Could not grant access - {e}')
+    if db.engine.dialect.name != 'postgresql' and len(inserted) < len(new):
+        # INSERT IGNORE also skips rows which fail for other reasons, like a user deleted since they were checked
+        db.session.rollback()
+        raise AccessError(
+            f'Could not grant {len(new) - len(inserted)} of the grants, as their users or events were just removed'
+        )
+    record_table_changes(
+        Access.__tablename__, [event for _, event in sorted(inserted)], 'insert'
+    )
+    change_row_counts({Access.__tablename__: len(inserted)})
+    success, reason = commit_transaction()
+    if not success:
+        raise AccessError(reason)
+    return len(inserted)
+
+
+def revoke_access(grants: set) -> int:
+    """
+    Function to revoke access to events
+    :param grants: Set of (username, event) tuples
+    :return: The number of grants which were revoked
+    :raises AccessError: if a user or event doesn't exist, or the grants couldn't be deleted
+    """
+    if not grants:
+        return 0
+    validate(grants)
+    # Locked, so that every one of them is still there to be deleted
+    revoked = sorted(existing_grants(grants, lock=True))
+    if not revoked:
+        db.session.rollback()
+        return 0
+    access = Access.__table__
+    result = db.session.execute(
+        access.delete().where(tuple_(access.c.user, access.c.event).in_(revoked))
+    )
+    record_table_changes(
+        Access.__tablename__, [event for _, event in revoked], 'delete'
+    )
+    change_row_counts({Access.__tablename__: -result.rowcount})
+    success, reason = commit_transaction()
+    if not success:
+        raise AccessError(reason)
+    return result.rowcount
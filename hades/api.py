@@ -1,26 +1,157 @@
-from json import dumps, loads
+import gzip
+from functools import wraps
+from hashlib import sha1
+from json import dumps
+from typing import Union
 
 from decouple import config
-from flask import jsonify, request
+from flask import Response, g, jsonify, make_response, request, stream_with_context
 from flask_login import login_required, current_user
-from sqlalchemy.exc import IntegrityError
+from flask_sqlalchemy import Model
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 
 from . import (
     app,
+    db,
     log,
 )
-from .db_utils import insert
+from .auth import generate_token
+from .db_utils import (
+    commit_transaction,
+    count_rows,
+    delete_row_from_table,
+    delete_rows_from_table,
+    get_versions,
+    insert,
+    insert_rows,
+    reserve_ids,
+    update_rows,
+)
+from .mail import substitution_tag
+from .models.api_token import ApiToken
+from .models.mail_job import MailJob
+from .models.user import hashing_pool
+from .models.validate import ValidateMixin
 from .utils import (
+    DATABASE_CLASSES,
     check_access,
     delete_user,
-    users_to_json,
-    send_mail,
+    get_allowed_events,
+    get_changes,
+    last_change,
+    select_contacts,
+    select_users,
     get_table_full_name,
     get_accessible_tables,
     get_table_by_name,
     users_to_csv,
+    log_sink,
+    tg,
+)
+
+
+# Query parameters of /api/users which are not filters on columns
+USERS_API_PARAMETERS = (
+    'table',
+    'csv',
+    'gzip',
+    'fields',
+    'order_by',
+    'after_id',
+    'limit',
 )
 
+# Number of rows returned per page by default, and at most
+API_PAGE_SIZE = config('API_PAGE_SIZE', default=100, cast=int)
+API_MAX_PAGE_SIZE = config('API_MAX_PAGE_SIZE', default=1000, cast=int)
+
+# Responses smaller than this many bytes are not worth compressing
+GZIP_MIN_SIZE = config('GZIP_MIN_SIZE', default=1024, cast=int)
+
+# Maximum number of users created or updated by a single batch request
+BATCH_MAX_SIZE = config('BATCH_MAX_SIZE', default=1000, cast=int)
+
+
+def compress(response: Response) -> Response:
+    """Gzips the body of a response if the client accepts it and it is large enough to be worth it"""
+    response.vary.add('Accept-Encoding')
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or 'gzip' not in request.accept_encodings
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def conditional(tables_for):
+    """
+    Decorator for read only endpoints whose response only depends on the user, the query string and a few tables
+
+    Responses carry a strong ETag built from the versions of those tables, and requests whose If-None-Match matches
+    it are answered with 304 Not Modified before the endpoint reads any rows. Large responses are gzipped
+    :param tables_for: Function returning the names of the tables the response is built from, None to skip caching
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = tables_for()
+            if names is None:
+                return compress(make_response(f(*args, **kwargs)))
+
+            # Every response also depends on the events the user, and the token used, has access to
+            versions = get_versions(sorted({'access', 'events', *names}))
+            scope = sorted(g.get('token_scope') or ())
+            key = f'{current_user.username}|{scope}|{request.full_path}|{sorted(versions.items())}'
+            etag = sha1(key.encode()).hexdigest()
+            # Compressed bodies differ from uncompressed ones, so they get an ETag of their own
+            for tag in (etag, f'{etag}-gzip'):
+                if request.if_none_match.contains(tag):
+                    response = Response(status=304)
+                    response.set_etag(tag)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            response = compress(make_response(f(*args, **kwargs)))
+            if response.status_code == 200:
+                if response.headers.get('Content-Encoding') == 'gzip':
+                    etag = f'{etag}-gzip'
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def event_tables() -> list:
+    """Tables /api/events is built from, besides access and events"""
+    return []
+
+
+def stats_tables():
+    """Tables /api/stats is built from"""
+    table_name = request.args.get('table')
+    if table_name is None:
+        return list(DATABASE_CLASSES)
+    return [table_name] if table_name in DATABASE_CLASSES else None
+
+
+def users_tables():
+    """Tables /api/users is built from"""
+    table_name = request.args.get('table')
+    if table_name == 'all':
+        return list(DATABASE_CLASSES)
+    return [table_name] if table_name in DATABASE_CLASSES else None
+
 
 @app.route('/api/authenticate', methods=['POST'])
 @login_required
@@ -32,8 +163,97 @@ def authenticate_api():
     )
 
 
+@app.route('/api/tokens', methods=['POST'])
+@login_required
+def create_token():
+    """
+    Creates an API token for the current user, to be sent as `Authorization: Bearer <token>`
+
+    Fields required
+
+    -> name - A name to recognize the token by
+    -> password - The password of the user, as the token grants the same access
+
+    Optional
+
+    -> events - Comma separated names of the events the token is limited to
+    """
+    if 'name' not in request.form or 'password' not in request.form:
+        return jsonify({'message': 'Please provide all required data'}), 400
+    if not current_user.check_password_hash(request.form['password']):
+        return jsonify({'message': 'Access denied'}), 401
+
+    events = None
+    if request.form.get('events'):
+        events = set(request.form['events'].split(','))
+        denied = events - get_allowed_events()
+        if denied:
+            return (
+                jsonify({'message': f'You do not have access to {", ".join(denied)}'}),
+                403,
+            )
+
+    token, digest = generate_token()
+    api_token = ApiToken(
+        digest=digest,
+        username=current_user.username,
+        name=request.form['name'],
+        events=','.join(sorted(events)) if events else None,
+    )
+    success, reason = insert([api_token])
+    if not success:
+        return jsonify({'message': f'Error occurred, {reason}'}), 500
+
+    log(
+        f'<code>{current_user.name}</code> has created API token <code>{api_token.name}</code>!'
+    )
+    # The token itself is not stored, so this is the only time it can be seen
+    return jsonify({'token': token, **api_token.to_json()}), 201
+
+
+@app.route('/api/tokens')
+@login_required
+def tokens_api():
+    """Returns a JSON consisting of the API tokens of the current user"""
+    tokens = ApiToken.query.filter(ApiToken.username == current_user.username)
+    return jsonify([api_token.to_json() for api_token in tokens]), 200
+
+
+@app.route('/api/tokens/<int:token_id>', methods=['DELETE'])
+@login_required
+def revoke_token(token_id: int):
+    """Revokes an API token of the current user"""
+    api_token = ApiToken.query.get(token_id)
+    if api_token is None or api_token.username != current_user.username:
+        return jsonify({'message': f'Token {token_id} does not exist!'}), 404
+    success, reason = delete_row_from_table(api_token)
+    if not success:
+        return jsonify({'message': f'Error occurred, {reason}'}), 500
+    log(
+        f'<code>{current_user.name}</code> has revoked API token <code>{api_token.name}</code>!'
+    )
+    return jsonify({'message': f'Revoked token {token_id}'}), 200
+
+
+@app.route('/api/metrics')
+@login_required
+def metrics_api():
+    """Returns a JSON consisting of internal counters, to keep an eye on background work"""
+    return (
+        jsonify(
+            {
+                'bcrypt': hashing_pool.stats(),
+                'log': log_sink.stats(),
+                'telegram': tg.stats(),
+            }
+        ),
+        200,
+    )
+
+
 @app.route('/api/events')
 @login_required
+@conditional(event_tables)
 def events_api():
     """Returns a JSON consisting of the tables the user has the permission to view"""
     ret = {}
@@ -50,6 +270,7 @@ def events_api():
 
 @app.route('/api/stats')
 @login_required
+@conditional(stats_tables)
 def stats_api():
     """Returns a JSON consisting of the tables the user has the permission to view and the users registered per table"""
     log(f'<code>{current_user.name}</code> is accessing the stats of events!')
@@ -60,30 +281,56 @@ def stats_api():
             return jsonify({'message': f'Table {table_name} does not exist'}), 400
         if check_access(table_name):
             return (
-                jsonify({get_table_full_name(table_name): len(table.query.all())}),
+                jsonify(
+                    {get_table_full_name(table_name): count_rows([table])[table_name]}
+                ),
                 200,
             )
         return (
             jsonify({'message': f'You do not have access to table {table}'}),
             403,
         )
-    ret = {}
-    for table in get_accessible_tables():
-        if table.name not in (
+    events = []
+    for event in get_accessible_tables():
+        if event.name in (
             'access',
             'events',
             'test_users',
             'tsg',
             'users',
         ):
-            ret[table.full_name] = len(get_table_by_name(table.name).query.all())
+            continue
+        if get_table_by_name(event.name) is not None:
+            events.append(event)
+    counts = count_rows([get_table_by_name(event.name) for event in events])
+    ret = {}
+    for event in events:
+        ret[event.full_name] = counts[event.name]
     return jsonify(ret), 200
 
 
 @app.route('/api/users')
 @login_required
+@conditional(users_tables)
 def users_api():
-    """Returns a JSON consisting of the users in the given table"""
+    """
+    Returns a JSON consisting of the users in the given table
+
+    Optional parameters
+
+    -> fields - comma separated names of the columns to be returned
+    -> order_by - column to order by, prefixed with `-` for descending order
+    -> limit - number of users per page
+    -> after_id - the `next` value of the previous page
+    -> any column name - only users whose value equals the given one, or starts with it if it ends with `*`. Other
+       parameters are ignored
+
+    If any of these are given, the response is a page of the form {"users": [...], "next": after_id of the next page}
+
+    With `table=all`, the response lists the contacts of everyone who registered for any of the tables the user has
+    access to. Given `limit` or `after_id`, it is a page of them in the form {"name": first name, "phone": phone
+    number, "events": [table names]}, else all of them as before, as a JSON encoded list of {"name", "phone"}
+    """
     table_name = request.args.get('table')
     if not table_name:
         return jsonify({'message': 'Please provide all required data'}), 400
@@ -92,37 +339,152 @@ def users_api():
         log(
             f'<code>{current_user.name}</code> is accessing all tables that they have access to!'
         )
-        tables = get_accessible_tables()
-        users = set()
-        for table in tables:
-            if table.name in ('access', 'events', 'users'):
-                continue
-            table_users = get_table_by_name(table.name).query.all()
-            for user in table_users:
-                phone = (
-                    user.phone.split('|')[1]
-                    if len(user.phone.split('|')) == 2
-                    else user.phone
+        tables = [
+            table.name
+            for table in get_accessible_tables()
+            if table.name not in ('access', 'events', 'users')
+        ]
+        paginated = 'limit' in request.args or 'after_id' in request.args
+        try:
+            limit = None
+            if paginated:
+                limit = min(
+                    max(int(request.args.get('limit', API_PAGE_SIZE)), 1),
+                    API_MAX_PAGE_SIZE,
                 )
-                if ',' in user.name:
-                    continue
-                name = user.name.split(' ')[0].title()
-                users.add(dumps({'name': name, 'phone': phone}))
-        final_users = []
-        for user in users:
-            final_users.append(loads(user))
-        return jsonify(dumps(final_users)), 200
+            users, next_id = select_contacts(
+                tables, after_id=request.args.get('after_id'), limit=limit
+            )
+        except ValueError:
+            return jsonify({'message': 'after_id and limit must be numbers'}), 400
+        # Clients which don't ask for pages get every contact, in the JSON encoded string they always got
+        if not paginated:
+            return (
+                jsonify(
+                    dumps(
+                        [
+                            {'name': user['name'], 'phone': user['phone']}
+                            for user in users
+                        ]
+                    )
+                ),
+                200,
+            )
+        return jsonify({'users': users, 'next': next_id}), 200
 
     log(f'<code>{current_user.name}</code> is accessing table {table_name}!')
-    access = check_access(table_name)
-    if access is None:
+    if not check_access(table_name):
         return jsonify({'message': 'Unauthorized'}), 401
     table = get_table_by_name(table_name)
     if table is None:
         return jsonify({'message': f'Table {table_name} does not exist!'}), 400
     if request.args.get('csv'):
-        return users_to_csv(table), 200
-    return jsonify(users_to_json(table.query.all())), 200
+        compress = bool(request.args.get('gzip'))
+        file_name = f'{table_name}.csv.gz' if compress else f'{table_name}.csv'
+        return Response(
+            stream_with_context(users_to_csv(table, compress)),
+            mimetype='application/gzip' if compress else 'text/csv',
+            headers={'Content-Disposition': f'attachment; filename={file_name}'},
+        )
+
+    # Other parameters, like the cache busters of some clients, are ignored
+    columns = table.__table__.columns
+    filters = {
+        k: v
+        for k, v in request.args.items()
+        if k not in USERS_API_PARAMETERS and k in columns
+    }
+    fields = request.args['fields'].split(',') if request.args.get('fields') else None
+    paginated = bool(filters) or any(
+        p in request.args for p in ('fields', 'order_by', 'after_id', 'limit')
+    )
+    try:
+        if 'limit' in request.args:
+            limit = min(max(int(request.args['limit']), 1), API_MAX_PAGE_SIZE)
+        else:
+            limit = API_PAGE_SIZE if paginated else None
+        users, next_id = select_users(
+            table,
+            fields=fields,
+            filters=filters,
+            order_by=request.args.get('order_by'),
+            after_id=request.args.get('after_id'),
+            limit=limit,
+        )
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Clients which don't ask for pages get the whole table, as before
+    if not paginated:
+        return (
+            jsonify(
+                [
+                    {k: v for k, v in user.items() if v is not None and v != ''}
+                    for user in users
+                ]
+            ),
+            200,
+        )
+    return jsonify({'users': users, 'next': next_id}), 200
+
+
+@app.route('/api/changes')
+@login_required
+def changes_api():
+    """
+    Returns a JSON consisting of the users of the given table which changed after a point, so that clients can keep a
+    copy of the table without downloading all of it again
+
+    Parameters
+
+    -> table - The name of the table
+    -> since - The `next` value of the previous response. Without it, only `next` is returned, to start from
+    -> limit - Maximum number of changes per response
+
+    The response is of the form {"users": [...], "deleted": [ids], "next": since of the next request, "more": bool}
+    Responses carry an ETag, and polls with a matching If-None-Match are answered with 304 Not Modified
+    """
+    table_name = request.args.get('table')
+    if not table_name:
+        return jsonify({'message': 'Please provide all required data'}), 400
+    if not check_access(table_name):
+        return jsonify({'message': 'Unauthorized'}), 401
+    table = get_table_by_name(table_name)
+    if table is None:
+        return jsonify({'message': f'Table {table_name} does not exist!'}), 400
+    try:
+        since = int(request.args['since']) if 'since' in request.args else None
+        limit = min(
+            max(int(request.args.get('limit', API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE
+        )
+    except ValueError:
+        return jsonify({'message': 'since and limit must be numbers'}), 400
+
+    latest = last_change(table)
+    if since is None:
+        return jsonify({'next': latest}), 200
+
+    # The response only depends on these, so an unchanged table is answered without reading any rows
+    etag = f'{table_name}-{since}-{latest}-{limit}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    log(
+        f'<code>{current_user.name}</code> is fetching changes to table {table_name} since {since}!'
+    )
+    users, deleted, next_seq = get_changes(table, since, latest, limit)
+    response = jsonify(
+        {
+            'users': users,
+            'deleted': deleted,
+            'next': next_seq,
+            'more': next_seq < latest,
+        }
+    )
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/create', methods=['POST'])
@@ -138,8 +500,7 @@ def create():
     if table is None:
         return jsonify({'message': f'Table {table_name} does not seem to exist!'}, 400)
 
-    access = check_access(table_name)
-    if access is None:
+    if not check_access(table_name):
         return jsonify({'message': 'Unauthorized'}), 401
 
     log(
@@ -175,10 +536,307 @@ def create():
     return jsonify({'message': f'Created user {user} successfully!'}), 200
 
 
+def read_batch() -> (Union[Model, None], list, Union[tuple, None]):
+    """
+    Function to read the table and users of a batch request, see `create_batch()`
+    :return: The table class, the users, and the response to be sent instead if the request is invalid
+    """
+    data = request.get_json(silent=True)
+    if (
+        not isinstance(data, dict)
+        or 'table' not in data
+        or not isinstance(data.get('users'), list)
+    ):
+        return None, [], (jsonify({'message': 'Please provide all required data'}), 400)
+    table_name = data['table']
+    if not check_access(table_name):
+        return None, [], (jsonify({'message': 'Unauthorized'}), 401)
+    table = get_table_by_name(table_name)
+    if table is None:
+        return (
+            None,
+            [],
+            (jsonify({'message': f'Table {table_name} does not seem to exist!'}), 400),
+        )
+    if len(data['users']) > BATCH_MAX_SIZE:
+        return (
+            None,
+            [],
+            (
+                jsonify({'message': f'At most {BATCH_MAX_SIZE} users per request'}),
+                400,
+            ),
+        )
+    return table, data['users'], None
+
+
+def check_values(table: Model, user: dict) -> Union[str, None]:
+    """
+    Checks the values of a user against the types of their columns, turning numbers given for text into text
+    :param table: The table class
+    :param user: The values to be written, only known columns
+    :return: Why a value doesn't fit its column, None if all of them do
+    """
+    columns = table.__table__.columns
+    for name, value in user.items():
+        column = columns[name]
+        if value is None:
+            if not column.nullable:
+                return f'{name} is required'
+            continue
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = object
+        if isinstance(value, bool):
+            valid = python_type in (bool, object)
+        elif python_type is bool:
+            valid = value in (0, 1)
+        elif python_type is int:
+            valid = isinstance(value, int) or (
+                isinstance(value, str) and value.strip().lstrip('-').isdigit()
+            )
+            if valid:
+                value = user[name] = int(value)
+        elif python_type is str and isinstance(value, (int, float)):
+            value = user[name] = str(value)
+            valid = True
+        else:
+            # Dates and times are given as text
+            valid = isinstance(value, str) or (
+                python_type is not str and isinstance(value, (int, float))
+            )
+        if not valid:
+            return f'Invalid value for {name}'
+        length = getattr(column.type, 'length', None)
+        if isinstance(value, str) and length is not None and len(value) > length:
+            return f'{name} is longer than {length} characters'
+    return None
+
+
+def check_batch(table: Model, rows: list, results: list, own_ids: list = None):
+    """
+    Marks the rows which collide with the table or with each other as conflicts in `results`
+    :param table: The table class
+    :param rows: The values to be written, for the rows which have no result yet
+    :param results: The results of the batch, rows are matched to them by their `index`
+    :param own_ids: For updates, the ID of every row
+    """
+    if not issubclass(table, ValidateMixin):
+        return
+    values = [{k: v for k, v in row.items() if k != 'index'} for row in rows]
+    try:
+        messages = table.check_batch(values, own_ids)
+    except SQLAlchemyError:
+        # Rows are then checked as they are written
+        db.session.rollback()
+        return
+    for row, message in zip(rows, messages):
+        if message is not None:
+            results[row['index']] = {'status': 'conflict', 'reason': message}
+
+
+def failed_row(table: Model, values: dict, own_id: int = None) -> dict:
+    """
+    Function to get the result of a user which couldn't be written, without passing on the error of the database
+    :param table: The table class
+    :param values: The values which were to be written
+    :param own_id: For updates, the ID of the user
+    :return: A conflict naming the field that collided if there was one, else an invalid result
+    """
+    if issubclass(table, ValidateMixin):
+        values = {k: v for k, v in values.items() if k != 'id'}
+        own_ids = None if own_id is None else [own_id]
+        try:
+            message = table.check_batch([values], own_ids)[0]
+        except SQLAlchemyError:
+            db.session.rollback()
+            message = None
+        if message is not None:
+            return {'status': 'conflict', 'reason': message}
+    return {
+        'status': 'invalid',
+        'reason': 'Could not save the user, please re-check the data',
+    }
+
+
+@app.route('/api/create/batch', methods=['POST'])
+@login_required
+def create_batch():
+    """
+    Creates many users, as specified in the JSON body of the request
+
+    -> table - The name of the table
+    -> users - List of objects, with the attributes of each user. IDs are assigned here
+
+    Every user is checked in one go, and those without conflicts are created in a single transaction. The response
+    has the result of every user, in order, as one of created (with its `id`), conflict or invalid (with a `reason`)
+    """
+    table, users, error = read_batch()
+    if error is not None:
+        return error
+    table_name = table.__tablename__
+
+    columns = set(table.__table__.columns.keys()) - {'id'}
+    results = [None] * len(users)
+    rows = []
+    for i, user in enumerate(users):
+        if not isinstance(user, dict):
+            results[i] = {'status': 'invalid', 'reason': 'Not an object'}
+        elif set(user) - columns:
+            unknown = ', '.join(sorted(set(user) - columns))
+            results[i] = {'status': 'invalid', 'reason': f'Unknown fields {unknown}'}
+        else:
+            user = dict(user)
+            reason = check_values(table, user)
+            if reason is not None:
+                results[i] = {'status': 'invalid', 'reason': reason}
+            else:
+                rows.append({**user, 'index': i})
+
+    check_batch(table, rows, results)
+    rows = [row for row in rows if results[row['index']] is None]
+    if rows:
+        last = reserve_ids(table, len(rows))
+        for id_, row in enumerate(rows, last - len(rows) + 1):
+            row['id'] = id_
+        values = [{k: v for k, v in row.items() if k != 'index'} for row in rows]
+        success, reason = insert_rows(table, values)
+        if success:
+            for row in rows:
+                results[row['index']] = {'status': 'created', 'id': row['id']}
+        else:
+            # Someone else took a value in the meantime, or a value was rejected, find out which rows are affected
+            for row, value in zip(rows, values):
+                try:
+                    success, reason = insert([table(**value)])
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    success = False
+                results[row['index']] = (
+                    {'status': 'created', 'id': row['id']}
+                    if success
+                    else failed_row(table, value)
+                )
+
+    created = sum(result['status'] == 'created' for result in results)
+    log(
+        f'User <code>{current_user.name}</code> has created {created} of {len(users)} users in <code>{table_name}</code>!'
+    )
+    return jsonify({'created': created, 'results': results}), 200
+
+
+@app.route('/api/update/batch', methods=['PUT'])
+@login_required
+def update_batch():
+    """
+    Updates many users, as specified in the JSON body of the request
+
+    -> table - The name of the table
+    -> users - List of objects, with the `id` of each user and the attributes to be updated
+
+    Every user is checked in one go, and those without conflicts are updated in a single transaction. The response
+    has the result of every user, in order, as one of updated, unchanged, conflict, invalid or not_found
+    """
+    table, users, error = read_batch()
+    if error is not None:
+        return error
+    table_name = table.__tablename__
+
+    columns = set(table.__table__.columns.keys())
+    results = [None] * len(users)
+    ids = {}
+    for i, user in enumerate(users):
+        if not isinstance(user, dict):
+            results[i] = {'status': 'invalid', 'reason': 'Not an object'}
+            continue
+        try:
+            id_ = int(user.get('id'))
+        except (TypeError, ValueError):
+            results[i] = {'status': 'invalid', 'reason': 'Missing or invalid id'}
+            continue
+        if set(user) - columns:
+            unknown = ', '.join(sorted(set(user) - columns))
+            results[i] = {'status': 'invalid', 'reason': f'Unknown fields {unknown}'}
+        elif id_ in ids.values():
+            results[i] = {'status': 'invalid', 'reason': f'ID {id_} is repeated'}
+        else:
+            users[i] = {k: v for k, v in user.items() if k != 'id'}
+            reason = check_values(table, users[i])
+            if reason is not None:
+                results[i] = {'status': 'invalid', 'reason': reason}
+            else:
+                ids[i] = id_
+
+    current = {}
+    if ids:
+        current = {
+            row['id']: row
+            for row in db.session.execute(
+                select(table.__table__).where(table.id.in_(ids.values()))
+            ).mappings()
+        }
+    rows = []
+    for i, id_ in ids.items():
+        if id_ not in current:
+            results[i] = {'status': 'not_found', 'reason': f'No user with ID {id_}'}
+            continue
+        changes = {k: v for k, v in users[i].items() if current[id_][k] != v}
+        if not changes:
+            results[i] = {'status': 'unchanged', 'id': id_}
+            continue
+        rows.append({**changes, 'index': i})
+
+    check_batch(table, rows, results, [ids[row['index']] for row in rows])
+    rows = [row for row in rows if results[row['index']] is None]
+    if rows:
+        values = [
+            {**{k: v for k, v in row.items() if k != 'index'}, 'id': ids[row['index']]}
+            for row in rows
+        ]
+        success, reason = update_rows(table, values)
+        if success:
+            for row, value in zip(rows, values):
+                results[row['index']] = {'status': 'updated', 'id': value['id']}
+        else:
+            # Someone else took a value in the meantime, or a value was rejected, find out which rows are affected
+            for row, value in zip(rows, values):
+                user = table.query.get(value['id'])
+                if user is None:
+                    # Deleted in the meantime
+                    results[row['index']] = {
+                        'status': 'not_found',
+                        'reason': f'No user with ID {value["id"]}',
+                    }
+                    continue
+                for k, v in value.items():
+                    setattr(user, k, v)
+                try:
+                    success, reason = commit_transaction()
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    success = False
+                results[row['index']] = (
+                    {'status': 'updated', 'id': value['id']}
+                    if success
+                    else failed_row(table, value, value['id'])
+                )
+
+    updated = sum(result['status'] == 'updated' for result in results)
+    log(
+        f'User <code>{current_user.name}</code> has updated {updated} of {len(users)} users in <code>{table_name}</code>!'
+    )
+    return jsonify({'updated': updated, 'results': results}), 200
+
+
 @app.route('/api/delete', methods=['DELETE'])
 @login_required
 def delete_api():
-    """Deletes the user as specified in the request data"""
+    """
+    Deletes the user as specified in the request data
+
+    `id` can also be a comma separated list of IDs, or `all`, which are deleted with a single statement
+    """
 
     # TODO: use utils.delete_user()
     # Ensure user has passed `table` and `id`
@@ -189,8 +847,7 @@ def delete_api():
         return jsonify({'message': 'Please provide all required data'}), 400
 
     # Confirm that the user has access to the desired table
-    access = check_access(table_name)
-    if access is None:
+    if not check_access(table_name):
         return (
             jsonify({'message': f'You are not authorized to access {table_name}'}),
             401,
@@ -200,19 +857,24 @@ def delete_api():
     if table is None:
         return jsonify({'message': f'{table_name} does not seem to exist!'}), 400
 
-    # Let us delete all entries, if so required
-    if id_ == 'all':
+    # Let us delete all entries, or a comma separated list of IDs, if so required
+    if id_ == 'all' or ',' in id_:
+        ids = None
+        if id_ != 'all':
+            try:
+                ids = [int(i) for i in id_.split(',') if i.strip()]
+            except ValueError:
+                return jsonify({'message': f'Invalid list of IDs {id_}'}), 400
+        success, result = delete_rows_from_table(table, ids)
+        if not success:
+            log(f'Could not delete users from {table_name} - {result}!')
+            return jsonify({'message': f'Could not delete users - {result}'}), 400
         log(
-            f'<code>{current_user.name}</code> is trying to delete all entries from table {table_name}!'
+            f'User <code>{current_user.name}</code> has deleted {result} users from <code>{table_name}</code>!'
+        )
+        return jsonify(
+            {'message': f'Deleted {result} users from {table_name}', 'deleted': result}
         )
-        # Store the message to be returned
-        ret = []
-        for user in table.query.all():
-            if delete_user(user.id, table_name):
-                ret.append(f'Deleted user {user} from {table_name}')
-            else:
-                ret.append(f'Failed to delete user {user} from {table_name}')
-        return jsonify({'message': ret})
 
     log(
         f'<code>{current_user.name}</code> is trying to delete ID {id_} from table {table_name}!'
@@ -252,8 +914,7 @@ def update_user():
     else:
         return jsonify({'message': 'Please provide all required data'}), 400
 
-    access = check_access(table_name)
-    if access is None:
+    if not check_access(table_name):
         return jsonify({'message': 'Unauthorized'}), 401
 
     table = get_table_by_name(table_name)
@@ -276,9 +937,8 @@ def update_user():
             log_message += f'\nUpdated {k} of {user.name} from {o} to {v}'
 
     log(log_message)
-    try:
-        table.query.session.commit()
-    except IntegrityError:
+    success, reason = commit_transaction()
+    if not success:
         return (
             jsonify(
                 {'message': 'Integrity constraint violated, please re-check your data!'}
@@ -304,52 +964,73 @@ def sendmail():
 
     if table_name in ('access', 'events', 'users'):
         return jsonify({'message': 'Seriously?'}), 400
-    access = check_access(table_name)
-    if access is None:
+    if not check_access(table_name):
         return jsonify({'message': 'Unauthorized'}), 401
 
     log(f'<code>{current_user.name}</code> is sending a mail to table {table_name}!')
 
     table = get_table_by_name(table_name)
+    if table is None:
+        return jsonify({'message': f'Table {table_name} does not exist!'}), 400
     if 'ids' in request.form and request.form['ids'] != 'all':
         ids = list(map(lambda x: int(x), request.form['ids'].split(' ')))
-        users = table.query.filter(table.id.in_(ids)).all()
+        total = table.query.filter(table.id.in_(ids)).count()
     else:
-        users = table.query.all()
+        ids = None
+        total = table.query.count()
 
     if 'email_address' in request.form:
         email_address = request.form['email_address']
     else:
         email_address = config('FROM_EMAIL', default='noreply@thescriptgroup.in')
 
-    for user in users:
-        if 'formattable_content' in request.form and 'content_fields' in request.form:
-            d = {}
-            for f in request.form['content_fields'].split(','):
-                d[f] = getattr(user, f)
-            content = request.form['content']
-            content += request.form['formattable_content'].format(**d)
-
-        else:
-            content = "<img src='https://drive.google.com/uc?id=12VCUzNvU53f_mR7Hbumrc6N66rCQO5r-&export=download' style='width:30%;height:50%'><hr><br> <b>Hey there!</b><br><br>" + str(
-                request.form['content']
-            ).replace(
-                '\n', '<br/>'
-            )
-
-        to_emails = []
-        if ',' in user.name:
-            to_emails.append((user.email.split(',')[0], user.name.split(',')[0]))
-            to_emails.append(
-                (user.email.split(',')[1].rstrip(), user.name.split(',')[1].rstrip())
-            )
-        else:
-            to_emails.append((user.email, user.name))
+    # Fields which differ per user are replaced by SendGrid, using substitution tags in the content
+    if 'formattable_content' in request.form and 'content_fields' in request.form:
+        fields = request.form['content_fields'].split(',')
+        content = request.form['content']
+        content += request.form['formattable_content'].format(
+            **{f: substitution_tag(f) for f in fields}
+        )
+    else:
+        fields = []
+        content = "<img src='https://drive.google.com/uc?id=12VCUzNvU53f_mR7Hbumrc6N66rCQO5r-&export=download' style='width:30%;height:50%'><hr><br> <b>Hey there!</b><br><br>" + str(
+            request.form['content']
+        ).replace(
+            '\n', '<br/>'
+        )
 
-        if not send_mail(email_address, to_emails, subject, content):
-            return jsonify({'message': f'Failed to send mail to {user}'}), 500
+    # The mails are sent by `hades.worker`, the progress can be followed at /api/jobs/<id>
+    job = MailJob(
+        table_name=table_name,
+        ids=' '.join(map(str, ids)) if ids is not None else None,
+        from_email=email_address,
+        subject=subject,
+        content=content,
+        fields=','.join(fields),
+        created_by=current_user.username,
+        total=total,
+    )
+    success, reason = insert([job])
+    if not success:
+        return jsonify({'message': f'Error occurred, {reason}'}), 500
 
     log(
-        f'User <code>{current_user.name}</code> has sent mails with subject <code>{subject}</code> to <code>{table_name}</code>!',
+        f'User <code>{current_user.name}</code> has queued mail job <code>{job.id}</code> with subject <code>{subject}</code> to <code>{table_name}</code> for {total} users!',
     )
-    return jsonify({'message': 'Sent mail'}), 200
+    return (
+        jsonify({'message': 'Queued mail', 'job': job.id, 'total': total}),
+        202,
+        {'Location': f'/api/jobs/{job.id}'},
+    )
+
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def jobs_api(job_id: int):
+    """Returns a JSON consisting of the progress of a mail job"""
+    job = MailJob.query.get(job_id)
+    if job is None:
+        return jsonify({'message': f'Job {job_id} does not exist!'}), 404
+    if job.created_by != current_user.username and not check_access(job.table_name):
+        return jsonify({'message': 'Unauthorized'}), 401
+    return jsonify(job.to_json()), 200
@@ -0,0 +1,99 @@
+"""
+Authentication of API calls
+
+External applications authenticate with an API token (`Authorization: Bearer <token>`), which is looked up by its
+SHA-256 digest without any bcrypt involved. The older `Credentials` header (a username and password) still works, and
+credentials which passed a bcrypt check are remembered for a short while, so that a client making many calls doesn't
+pay for bcrypt on every one of them
+"""
+
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Union
+
+from decouple import config
+
+from hades.models.api_token import ApiToken
+
+# Number of verified credentials remembered by a worker, and for how many seconds
+CREDENTIALS_CACHE_SIZE = config('CREDENTIALS_CACHE_SIZE', default=256, cast=int)
+CREDENTIALS_CACHE_TTL = config('CREDENTIALS_CACHE_TTL', default=60, cast=int)
+
+
+def token_digest(token: str) -> str:
+    """Returns the digest under which a token is stored"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def generate_token() -> (str, str):
+    """
+    Function to generate a new API token
+    :return: The token, which is only ever shown to its user, and its digest
+    """
+    token = secrets.token_urlsafe(32)
+    return token, token_digest(token)
+
+
+def find_token(token: str) -> Union[ApiToken, None]:
+    """
+    Function to look up an API token
+    :param token: The token as sent by the client
+    :return: The token object if the token is valid, else None
+    """
+    digest = token_digest(token)
+    api_token = ApiToken.query.filter(ApiToken.digest == digest).first()
+    if api_token is None or not hmac.compare_digest(api_token.digest, digest):
+        return None
+    return api_token
+
+
+class CredentialCache:
+    """
+    Class to remember credentials which passed a bcrypt check
+
+    Credentials are only kept as a keyed digest, never in plain text. Every entry is tied to the password hash it was
+    checked against, so changing a password invalidates it. Entries expire after `ttl` seconds, and the least
+    recently used ones are evicted once `max_size` are held
+
+    -> get: returns whether the credentials were verified against the given password hash
+    -> put: remembers verified credentials
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key = secrets.token_bytes(32)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def digest(self, credentials: str) -> bytes:
+        return hmac.new(self.key, credentials.encode('utf-8'), hashlib.sha256).digest()
+
+    def get(self, credentials: str, password_hash: str) -> bool:
+        digest = self.digest(credentials)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return False
+            if entry[0] != password_hash or time.monotonic() - entry[1] > self.ttl:
+                del self.entries[digest]
+                return False
+            self.entries.move_to_end(digest)
+            return True
+
+    def put(self, credentials: str, password_hash: str):
+        if self.max_size <= 0:
+            return
+        digest = self.digest(credentials)
+        with self.lock:
+            self.entries[digest] = (password_hash, time.monotonic())
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+credential_cache = CredentialCache(CREDENTIALS_CACHE_SIZE, CREDENTIALS_CACHE_TTL)
@@ -0,0 +1,201 @@
+"""
+Copying of a whole database, for `python -m hades clone`
+
+Rows are streamed from the source a chunk at a time, and written with one executemany `INSERT` per chunk, each table
+in a single transaction. Tables which don't depend on each other are copied in parallel over separate connections,
+while a table with foreign keys waits for the tables it references, so `access` is copied after `events` and `users`
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from decouple import config
+from sqlalchemy import MetaData, create_engine, func, inspect, select
+
+from hades import db
+from hades.db_utils import seed_id_counters
+from hades.utils import DATABASE_CLASSES
+
+# Number of rows read and written at a time
+CLONE_CHUNK_SIZE = config('CLONE_CHUNK_SIZE', default=5000, cast=int)
+
+# Number of tables copied in parallel
+CLONE_WORKERS = config('CLONE_WORKERS', default=4, cast=int)
+
+
+class CloneError(Exception):
+    """Raised when a database can't be copied, before anything was written to it"""
+
+
+class Progress:
+    """
+    Class to print how far along a copy is
+
+    -> advance: records that rows of a table were copied, and prints the progress
+    """
+
+    def __init__(self, totals: dict):
+        self.totals = totals
+        self.copied = dict.fromkeys(totals, 0)
+        self.lock = Lock()
+
+    def advance(self, name: str, count: int):
+        with self.lock:
+            self.copied[name] += count
+            done = sum(self.copied.values())
+            total = sum(self.totals.values())
+            print(
+                f'{name}: {self.copied[name]}/{self.totals[name]} rows, {done}/{total} overall'
+            )
+
+
+def get_tables(engine, names: list = None) -> (dict, dict):
+    """
+    Function to get the tables of a database
+    :param engine: Engine of the database
+    :param names: Names of the tables to get, defaults to all of them
+    :return: The tables as they are in the database, and as they should be created, using the model where there is one
+    :raises CloneError: if any of the given tables doesn't exist
+    """
+    DATABASE_CLASSES.import_models()
+    reflected = MetaData()
+    reflected.reflect(bind=engine)
+    if names is None:
+        names = list(reflected.tables)
+    missing = [name for name in names if name not in reflected.tables]
+    if missing:
+        raise CloneError(f'Tables {", ".join(missing)} do not exist')
+    source = {name: reflected.tables[name] for name in names}
+    # The models know the types better than reflection does, which matters when copying across databases
+    target = {name: db.metadata.tables.get(name, source[name]) for name in names}
+    return source, target
+
+
+def dependency_levels(tables: dict) -> list:
+    """
+    Function to order tables by their foreign keys
+    :param tables: The tables, by name
+    :return: Lists of names of tables, each list only referencing the tables in the lists before it
+    """
+    levels = {}
+
+    def level(name: str) -> int:
+        if name not in levels:
+            # Guards against cycles, which are then copied in any order
+            levels[name] = 0
+            references = {
+                fk.target_fullname.split('.')[0] for fk in tables[name].foreign_keys
+            }
+            references = references.intersection(tables) - {name}
+            levels[name] = 1 + max(map(level, references), default=-1)
+        return levels[name]
+
+    ret = []
+    for name in tables:
+        while len(ret) <= level(name):
+            ret.append([])
+        ret[level(name)].append(name)
+    return ret
+
+
+def count_rows(engine, tables: dict) -> dict:
+    """Returns the number of rows in each of the given tables"""
+    with engine.connect() as connection:
+        return {
+            name: connection.execute(select(func.count()).select_from(table)).scalar()
+            for name, table in tables.items()
+        }
+
+
+def copy_rows(source, dest, query, table, chunk_size: int, progress: Progress) -> int:
+    """
+    Function to copy the rows selected by a query into a table, in chunks, in one transaction
+    :param source: Engine of the database to read from
+    :param dest: Engine of the database to write to
+    :param query: Select of the rows to copy
+    :param table: Table to write the rows to
+    :param chunk_size: Number of rows read and written at a time
+    :param progress: Progress to advance as chunks are written
+    :return: The number of rows copied
+    """
+    columns = set(table.columns.keys())
+    copied = 0
+    with source.connect() as src, dest.begin() as dst:
+        result = src.execution_options(stream_results=True).execute(query)
+        for chunk in result.partitions(chunk_size):
+            rows = [
+                {k: v for k, v in row._mapping.items() if k in columns} for row in chunk
+            ]
+            dst.execute(table.insert(), rows)
+            copied += len(rows)
+            progress.advance(table.name, len(rows))
+    return copied
+
+
+def clone_database(
+    dest_url: str,
+    source_url: str = None,
+    names: list = None,
+    chunk_size: int = CLONE_CHUNK_SIZE,
+    workers: int = CLONE_WORKERS,
+) -> int:
+    """
+    Function to copy the tables of one database into another, creating them if they don't exist
+    :param dest_url: URL of the database to copy to, whose tables have to be empty
+    :param source_url: URL of the database to copy from, defaults to that of the application
+    :param names: Names of the tables to copy, defaults to all of them
+    :param chunk_size: Number of rows read and written at a time
+    :param workers: Number of tables copied in parallel
+    :return: The number of rows copied
+    :raises CloneError: if a table doesn't exist in the source, or already has rows in the destination
+    """
+    source = create_engine(source_url) if source_url else db.engine
+    dest = create_engine(dest_url)
+    # SQLite only allows one writer at a time
+    if dest.dialect.name == 'sqlite':
+        workers = 1
+
+    source_tables, dest_tables = get_tables(source, names)
+    created = set(inspect(dest).get_table_names())
+    existing = count_rows(
+        dest, {name: table for name, table in dest_tables.items() if name in created}
+    )
+    if any(existing.values()):
+        full = ', '.join(name for name, count in existing.items() if count)
+        raise CloneError(f'Tables {full} are not empty in the destination')
+
+    levels = dependency_levels(dest_tables)
+    for level in levels:
+        for name in level:
+            dest_tables[name].create(dest, checkfirst=True)
+
+    progress = Progress(count_rows(source, source_tables))
+    start = time.monotonic()
+    copied = 0
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        for level in levels:
+            futures = []
+            for name in level:
+                table = source_tables[name]
+                query = select(table).order_by(*table.primary_key.columns)
+                futures.append(
+                    executor.submit(
+                        copy_rows,
+                        source,
+                        dest,
+                        query,
+                        dest_tables[name],
+                        chunk_size,
+                        progress,
+                    )
+                )
+            # Tables of the next level reference these, so they have to be done first
+            copied += sum(future.result() for future in futures)
+    # The copied rows were written without the ID counters
+    with dest.begin() as connection:
+        seed_id_counters(connection, dest_tables)
+    print(
+        f'Copied {copied} rows of {len(source_tables)} tables in {time.monotonic() - start:.1f}s'
+    )
+    return copied
@@ -1,10 +1,256 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from threading import Lock
 from typing import Union, List
 
+from decouple import config
 from flask_sqlalchemy import Model
-from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy import (
+    Integer,
+    bindparam,
+    event,
+    func,
+    inspect,
+    literal,
+    select,
+    true,
+)
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
 
 from hades import db
+from hades.models.change import Change
+from hades.models.contact import add_contacts, remove_contacts
+from hades.models.id_counter import IdCounter
+from hades.models.open_change import OpenChange
+from hades.models.phone_number import PhoneNumber
+from hades.models.row_count import RowCount
+from hades.models.table_version import TableVersion
 from hades.models.user import TSG
+from hades.models.validate import ValidateMixin
+
+# Number of IDs a worker reserves at a time, so that most registrations don't touch the counter at all. With more than
+# one worker, IDs are no longer handed out in order of registration, and the unused part of a block is skipped when a
+# worker restarts, set it to 1 if IDs have to be in order and without gaps
+ID_BLOCK_SIZE = config('ID_BLOCK_SIZE', default=20, cast=int)
+
+# Blocks of IDs reserved by this worker, table name -> [next ID, last ID]
+id_blocks = {}
+id_blocks_lock = Lock()
+
+# Seconds after which a transaction writing to the change log is assumed to have died, like with its worker, and no
+# longer holds back the changes after it
+CHANGES_MAX_OPEN_SECONDS = config('CHANGES_MAX_OPEN_SECONDS', default=600, cast=int)
+
+# Tables which are only used internally, their rows are not counted
+UNTRACKED_TABLES = (
+    'api_tokens',
+    'changes',
+    'contact_sources',
+    'contacts',
+    'id_counters',
+    'mail_jobs',
+    'open_changes',
+    'outbox',
+    'phone_numbers',
+    'profile_cache',
+    'row_counts',
+    'table_versions',
+)
+
+
+def change_row_counts(deltas: dict):
+    """
+    Function to adjust the cached row counts of tables, as part of the current transaction
+    :param deltas: Dictionary of table names, mapped to the number of rows added (negative if removed)
+    """
+    counts = RowCount.__table__
+    for name, delta in deltas.items():
+        if delta == 0 or name in UNTRACKED_TABLES:
+            continue
+        db.session.execute(
+            counts.update()
+            .where(counts.c.name == name)
+            .values(row_count=counts.c.row_count + delta)
+        )
+
+
+def bump_versions(names: set):
+    """
+    Function to increase the versions of the given tables, as part of the current transaction
+    :param names: Names of the tables which were changed
+    """
+    versions = TableVersion.__table__
+    for name in sorted(names):
+        db.session.execute(
+            versions.update()
+            .where(versions.c.name == name)
+            .values(version=versions.c.version + 1)
+        )
+
+
+def get_versions(names: list) -> dict:
+    """
+    Function to get the versions of the given tables
+
+    Tables which don't have a version yet start at 0. A version is only handed out once it is stored, so every later
+    change to the table bumps it
+    :param names: Names of the tables
+    :return: Dictionary of table names, mapped to their versions
+    """
+    versions = TableVersion.__table__
+    ret = dict(
+        db.session.execute(
+            select(versions.c.name, versions.c.version).where(
+                versions.c.name.in_(names)
+            )
+        ).all()
+    )
+    for name in names:
+        if name in ret:
+            continue
+        ret[name] = 0
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(versions.insert().values(name=name, version=0))
+        except IntegrityError:
+            # Another worker added it at the same time. If it was bumped already, handing out 0 only costs a cache miss
+            pass
+    return ret
+
+
+def open_changes():
+    """
+    Function to register the current transaction as writing to the change log, until it commits
+
+    Sequence numbers are handed out as changes are written, so a transaction which commits slowly can commit a lower
+    one after a higher one. Changes are only handed out up to the oldest transaction still open, see `settled_seq`
+    """
+    # SQLite has one writer at a time, which commits its changes before the next one can write any
+    if 'open_change' in db.session.info or db.engine.dialect.name == 'sqlite':
+        return
+    opens = OpenChange.__table__
+    expired = datetime.utcnow() - timedelta(seconds=CHANGES_MAX_OPEN_SECONDS)
+    with db.engine.begin() as connection:
+        connection.execute(opens.delete().where(opens.c.opened_at <= expired))
+        floor = connection.execute(select(func.max(Change.seq))).scalar() or 0
+        id_ = connection.execute(
+            opens.insert().values(floor=floor, opened_at=datetime.utcnow())
+        ).inserted_primary_key[0]
+    # Deleted as part of the transaction, so it is gone exactly when the changes become visible
+    db.session.execute(opens.delete().where(opens.c.id == id_))
+    db.session.info['open_change'] = id_
+
+
+@event.listens_for(db.session, 'after_commit')
+def close_changes(session):
+    session.info.pop('open_change', None)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def abandon_changes(session):
+    # The delete was rolled back with the rest of the transaction
+    id_ = session.info.pop('open_change', None)
+    if id_ is not None:
+        opens = OpenChange.__table__
+        with db.engine.begin() as connection:
+            connection.execute(opens.delete().where(opens.c.id == id_))
+
+
+def settled_seq(connection, name: str) -> int:
+    """
+    Function to get the sequence number up to which the changes to a table are all committed
+
+    Transactions open for longer than CHANGES_MAX_OPEN_SECONDS are assumed to have died with their worker
+    :param connection: Connection to the database
+    :param name: Name of the table
+    :return: The sequence number, 0 if the table has not changed yet
+    """
+    opens = OpenChange.__table__
+    query = select(func.max(Change.seq)).where(Change.table_name == name)
+    if connection.dialect.name != 'sqlite':
+        expired = datetime.utcnow() - timedelta(seconds=CHANGES_MAX_OPEN_SECONDS)
+        floor = connection.execute(
+            select(func.min(opens.c.floor)).where(opens.c.opened_at > expired)
+        ).scalar()
+        if floor is not None:
+            query = query.where(Change.seq <= floor)
+    return connection.execute(query).scalar() or 0
+
+
+def record_changes(objects: list, op: str):
+    """
+    Function to add the given rows to the change log and bump the versions of their tables, as part of the current
+    transaction
+    :param objects: List of objects, flushed already so that their primary keys are known
+    :param op: insert, update or delete
+    """
+    rows = []
+    for user in objects:
+        if user.__tablename__ in UNTRACKED_TABLES:
+            continue
+        key = inspect(user).mapper.primary_key_from_instance(user)[0]
+        rows.append({'table_name': user.__tablename__, 'row_id': str(key), 'op': op})
+    if rows:
+        open_changes()
+        db.session.execute(Change.__table__.insert(), rows)
+        bump_versions({row['table_name'] for row in rows})
+
+
+def record_table_changes(name: str, row_ids: list, op: str):
+    """
+    Function to add rows written with a bulk statement to the change log and bump the version of their table, as part
+    of the current transaction
+    :param name: Name of the table
+    :param row_ids: The first column of the primary key of every row
+    :param op: insert, update or delete
+    """
+    if name in UNTRACKED_TABLES or not row_ids:
+        return
+    open_changes()
+    db.session.execute(
+        Change.__table__.insert(),
+        [{'table_name': name, 'row_id': str(key), 'op': op} for key in row_ids],
+    )
+    bump_versions({name})
+
+
+def count_rows(tables: List[Model]) -> dict:
+    """
+    Function to get the number of rows of the given tables
+
+    Counts are read from the `row_counts` table in a single query. Tables which are not counted there yet are counted
+    with COUNT(*) once, and added to it by the same statement in its own transaction. Otherwise rows written in
+    between counting and storing the count would be missed by `change_row_counts`
+    :param tables: List of table classes
+    :return: Dictionary of table names, mapped to their number of rows
+    """
+    counts = RowCount.__table__
+    names = [table.__tablename__ for table in tables]
+    ret = dict(
+        db.session.execute(
+            select(counts.c.name, counts.c.row_count).where(counts.c.name.in_(names))
+        ).all()
+    )
+    for table in tables:
+        name = table.__tablename__
+        if name in ret:
+            continue
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    counts.insert().from_select(
+                        ['name', 'row_count'],
+                        select(literal(name), func.count()).select_from(table),
+                    )
+                )
+        except IntegrityError:
+            # Another worker counted it at the same time
+            pass
+        with db.engine.connect() as connection:
+            ret[name] = connection.execute(
+                select(counts.c.row_count).where(counts.c.name == name)
+            ).scalar()
+    return ret
 
 
 def insert(objects: List[Model]) -> (bool, str):
@@ -15,7 +261,13 @@ def insert(objects: List[Model]) -> (bool, str):
     """
     try:
         for user in objects:
+            # IDs of registrations come from the counter, which the database's own would collide with
+            if isinstance(user, ValidateMixin) and getattr(user, 'id', 0) is None:
+                user.id = allocate_id(user.__class__)
             db.session.add(user)
+        db.session.flush()
+        record_changes(objects, 'insert')
+        change_row_counts(Counter(user.__tablename__ for user in objects))
         db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
@@ -26,6 +278,85 @@ def insert(objects: List[Model]) -> (bool, str):
     return True, ''
 
 
+def reserve_ids(table: Model, count: int) -> int:
+    """
+    Function to atomically reserve a block of IDs for a table, in its own transaction
+
+    The counter starts after the highest ID in use when it is created, rows copied in without it, like by a clone,
+    move it along in `seed_id_counters`
+    :param table: The table class
+    :param count: The number of IDs to be reserved
+    :return: The last ID of the reserved block
+    """
+    counters = IdCounter.__table__
+    name = table.__tablename__
+    update = (
+        counters.update()
+        .where(counters.c.name == name)
+        .values(value=counters.c.value + count)
+    )
+    try:
+        with db.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                last = connection.execute(update.returning(counters.c.value)).scalar()
+                if last is not None:
+                    return last
+            elif connection.execute(update).rowcount:
+                return connection.execute(
+                    select(counters.c.value).where(counters.c.name == name)
+                ).scalar()
+            # First reservation for this table
+            current = connection.execute(select(func.max(table.id))).scalar() or 0
+            connection.execute(
+                counters.insert().values(name=name, value=current + count)
+            )
+            return current + count
+    except IntegrityError:
+        # Another worker created the counter at the same time, it exists now
+        return reserve_ids(table, count)
+
+
+def seed_id_counters(connection, tables: dict):
+    """
+    Function to move the ID counters of tables past their highest ID, after rows were written without them
+    :param connection: Connection to the database the rows were written to
+    :param tables: The tables, by name
+    """
+    counters = IdCounter.__table__
+    if not inspect(connection).has_table(counters.name):
+        return
+    for name, table in tables.items():
+        if 'id' not in table.c or not isinstance(table.c.id.type, Integer):
+            continue
+        current = connection.execute(select(func.max(table.c.id))).scalar()
+        if current is not None:
+            connection.execute(
+                counters.update()
+                .where(counters.c.name == name, counters.c.value < current)
+                .values(value=current)
+            )
+
+
+def allocate_id(table: Model) -> int:
+    """
+    Function to hand out a new ID for a row of the given table
+
+    IDs are reserved in blocks of ID_BLOCK_SIZE, so most calls don't touch the database. An ID is never handed out
+    twice, even across workers, and is known before the row is inserted
+    :param table: The table class
+    :return: The ID
+    """
+    name = table.__tablename__
+    with id_blocks_lock:
+        block = id_blocks.get(name)
+        if block is None or block[0] > block[1]:
+            last = reserve_ids(table, ID_BLOCK_SIZE)
+            block = id_blocks[name] = [last - ID_BLOCK_SIZE + 1, last]
+        id_ = block[0]
+        block[0] += 1
+    return id_
+
+
 def get_user(table: Model, id_: str) -> Union[Model, None]:
     """
     Function to check whether a given id exists in a table or not
@@ -58,6 +389,7 @@ def update_row_in_table(user: Model, column: str, value) -> (bool, str):
         return True, ''
     setattr(user, column, value)
     try:
+        record_changes([user], 'update')
         db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
@@ -79,6 +411,8 @@ def delete_row_from_table(user: Model) -> (bool, str):
 
     db.session.delete(user)
     try:
+        record_changes([user], 'delete')
+        change_row_counts({user.__tablename__: -1})
         db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
@@ -89,12 +423,145 @@ def delete_row_from_table(user: Model) -> (bool, str):
     return True, ''
 
 
-def commit_transaction() -> (bool, str):
+def delete_rows_from_table(table: Model, ids: list = None) -> (bool, Union[int, str]):
     """
-    Function to commit the current changes in the database
+    Function to delete many users from the given table with a single statement
+
+    The ORM isn't involved, so the phone numbers and contacts of the users are removed here, in the same transaction
+    :param table: The table class
+    :param ids: IDs of the users, None to delete all of them
+    :return: success, and the number of users deleted if success, else the reason
+    """
+    name = table.__tablename__
+    condition = true() if ids is None else table.id.in_(ids)
+    try:
+        # Locks the rows, so that the IDs logged are exactly the ones deleted
+        deleted = (
+            db.session.execute(select(table.id).where(condition).with_for_update())
+            .scalars()
+            .all()
+        )
+        if not deleted:
+            db.session.rollback()
+            return True, 0
+        result = db.session.execute(table.__table__.delete().where(condition))
+        row_ids = None if ids is None else deleted
+        numbers = PhoneNumber.__table__
+        index = numbers.c.table_name == name
+        if row_ids is not None:
+            index &= numbers.c.row_id.in_(row_ids)
+        db.session.execute(numbers.delete().where(index))
+        remove_contacts(db.session, name, row_ids)
+        record_table_changes(name, deleted, 'delete')
+        change_row_counts({name: -result.rowcount})
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        return False, f'IntegrityError occurred - {e}'
+    except DataError as e:
+        db.session.rollback()
+        return False, f'DataError occurred - {e}'
+    return True, result.rowcount
+
+
+def insert_rows(table: Model, rows: List[dict]) -> (bool, str):
+    """
+    Function to insert many users into the given table with a single executemany, in one transaction
+
+    The ORM isn't involved, so the phone numbers and contacts of the users are added here
+    :param table: The table class
+    :param rows: Dictionaries of the values of every user, including their `id`
+    :return: success, and reason if failure (empty on success)
+    """
+    name = table.__tablename__
+    # An executemany needs the same columns in every row, users leaving out optional fields are inserted separately
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    try:
+        for group in groups.values():
+            db.session.execute(table.__table__.insert(), group)
+        if issubclass(table, ValidateMixin):
+            numbers = []
+            for row in rows:
+                numbers += PhoneNumber.rows_for(name, row['id'], row.get('phone'))
+            if numbers:
+                db.session.execute(PhoneNumber.__table__.insert(), numbers)
+        add_contacts(db.session, name, rows)
+        record_table_changes(name, [row['id'] for row in rows], 'insert')
+        change_row_counts({name: len(rows)})
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        return False, f'IntegrityError occurred - {e}'
+    except DataError as e:
+        db.session.rollback()
+        return False, f'DataError occurred - {e}'
+    except SQLAlchemyError as e:
+        # Like values of the wrong type, which are only caught when the statement is built
+        db.session.rollback()
+        return False, f'{e.__class__.__name__} occurred - {e}'
+    return True, ''
+
+
+def update_rows(table: Model, rows: List[dict]) -> (bool, str):
+    """
+    Function to update many users of the given table, with one executemany per set of columns changed, in one
+    transaction
+
+    The ORM isn't involved, so the phone numbers and contacts of the users are updated here
+    :param table: The table class
+    :param rows: Dictionaries of the `id` of every user, and the values to be changed
     :return: success, and reason if failure (empty on success)
     """
+    name = table.__tablename__
+    columns = table.__table__.c
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(k for k in row if k != 'id')), []).append(row)
     try:
+        for fields, group in groups.items():
+            db.session.execute(
+                table.__table__.update()
+                .where(columns.id == bindparam('key_id'))
+                .values({field: bindparam(f'value_{field}') for field in fields}),
+                [
+                    {
+                        'key_id': row['id'],
+                        **{f'value_{field}': row[field] for field in fields},
+                    }
+                    for row in group
+                ],
+            )
+
+        # The indexes are rebuilt from the rows as they are now
+        changed = [row['id'] for row in rows if 'name' in row or 'phone' in row]
+        if changed and 'phone' in columns:
+            current = db.session.execute(
+                select(columns.id, columns.name, columns.phone).where(
+                    columns.id.in_(changed)
+                )
+            ).mappings()
+            current = [dict(row) for row in current]
+            rephoned = {row['id'] for row in rows if 'phone' in row}
+            if rephoned and issubclass(table, ValidateMixin):
+                numbers = PhoneNumber.__table__
+                db.session.execute(
+                    numbers.delete()
+                    .where(numbers.c.table_name == name)
+                    .where(numbers.c.row_id.in_(rephoned))
+                )
+                indexed = []
+                for row in current:
+                    if row['id'] in rephoned:
+                        indexed += PhoneNumber.rows_for(name, row['id'], row['phone'])
+                if indexed:
+                    db.session.execute(numbers.insert(), indexed)
+            if 'name' in columns:
+                remove_contacts(db.session, name, changed)
+                add_contacts(db.session, name, current)
+
+        record_table_changes(name, [row['id'] for row in rows], 'update')
         db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
@@ -102,6 +569,39 @@ def commit_transaction() -> (bool, str):
     except DataError as e:
         db.session.rollback()
         return False, f'DataError occurred - {e}'
+    except SQLAlchemyError as e:
+        # Like values of the wrong type, which are only caught when the statement is built
+        db.session.rollback()
+        return False, f'{e.__class__.__name__} occurred - {e}'
+    return True, ''
+
+
+def commit_transaction() -> (bool, str):
+    """
+    Function to commit the current changes in the database
+
+    Rows added, changed or deleted in the session since its last flush are recorded in the change log and row counts
+    :return: success, and reason if failure (empty on success)
+    """
+    session = db.session
+    new = list(session.new)
+    dirty = [user for user in session.dirty if session.is_modified(user)]
+    deleted = list(session.deleted)
+    try:
+        session.flush()
+        record_changes(new, 'insert')
+        record_changes(dirty, 'update')
+        record_changes(deleted, 'delete')
+        deltas = Counter(user.__tablename__ for user in new)
+        deltas.subtract(user.__tablename__ for user in deleted)
+        change_row_counts(deltas)
+        session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        return False, f'IntegrityError occurred - {e}'
+    except DataError as e:
+        session.rollback()
+        return False, f'DataError occurred - {e}'
     return True, ''
 
 
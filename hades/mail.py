@@ -0,0 +1,193 @@
+"""
+Bulk mail engine, used to send the same mail to many recipients
+
+Instead of one SendGrid request per recipient, recipients are grouped into personalizations of a single request, with
+per-recipient substitutions for the parts of the content which differ. Batches are sent concurrently over the shared
+SendGrid client, and the outcome is reported for every recipient
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple
+
+from decouple import config
+
+from . import db
+from .models.mail_job import MailJob
+from .utils import SENDGRID_API_KEY, get_sendgrid_client, get_table_by_name, log
+
+# SendGrid accepts at most 1000 recipients in a single request
+MAIL_BATCH_SIZE = min(config('MAIL_BATCH_SIZE', default=1000, cast=int), 1000)
+
+# Number of batches sent at the same time
+MAIL_CONCURRENCY = config('MAIL_CONCURRENCY', default=4, cast=int)
+
+# Number of users handled in one step of a mail job, progress is saved after every step
+MAIL_JOB_CHUNK_SIZE = config('MAIL_JOB_CHUNK_SIZE', default=500, cast=int)
+
+
+class Recipient(NamedTuple):
+    """
+    A single recipient of a bulk mail
+
+    -> key: identifies the recipient in the results, for example the ID of the user
+    -> to: list of (email, name) tuples, all of whom receive the same personalized mail
+    -> substitutions: dictionary of tags in the content, mapped to the values for this recipient
+    """
+
+    key: object
+    to: list
+    substitutions: dict = {}
+
+
+def substitution_tag(field: str) -> str:
+    """Returns the tag which is replaced with the value of `field` for every recipient"""
+    return f'-{field}-'
+
+
+def recipients_for(users: list, fields: list) -> list:
+    """
+    Function to build the recipients for the given users of an event table
+    :param users: List of user objects
+    :param fields: Names of the fields to be substituted in the content
+    :return: List of `Recipient`s, keyed by user ID
+    """
+    recipients = []
+    for user in users:
+        to_emails = []
+        # Group registrations have both names and emails separated by a comma
+        if ',' in user.name:
+            to_emails.append((user.email.split(',')[0], user.name.split(',')[0]))
+            to_emails.append(
+                (user.email.split(',')[1].rstrip(), user.name.split(',')[1].rstrip())
+            )
+        else:
+            to_emails.append((user.email, user.name))
+        substitutions = {substitution_tag(f): getattr(user, f) for f in fields}
+        recipients.append(Recipient(user.id, to_emails, substitutions))
+    return recipients
+
+
+def batches(recipients: list) -> list:
+    """Splits the recipients into batches with at most MAIL_BATCH_SIZE email addresses each"""
+    ret = [[]]
+    count = 0
+    for recipient in recipients:
+        if ret[-1] and count + len(recipient.to) > MAIL_BATCH_SIZE:
+            ret.append([])
+            count = 0
+        ret[-1].append(recipient)
+        count += len(recipient.to)
+    return ret if ret[0] else []
+
+
+def send_batch(from_user, recipients: list, subject: str, content: str) -> (bool, str):
+    """
+    Function to send one mail with a personalization per recipient
+    :return: success, and reason if failure (empty on success)
+    """
+    from sendgrid.helpers.mail import Content, Mail, Personalization, Substitution, To
+
+    mail = Mail(from_user, subject=subject)
+    mail.add_content(Content('text/html', content))
+    for recipient in recipients:
+        personalization = Personalization()
+        for email, name in recipient.to:
+            personalization.add_to(To(email, name))
+        for tag, value in recipient.substitutions.items():
+            personalization.add_substitution(Substitution(tag, str(value)))
+        mail.add_personalization(personalization)
+    try:
+        get_sendgrid_client().send(mail)
+    except Exception as e:
+        return False, str(e)
+    return True, ''
+
+
+def send_bulk_mail(from_user, recipients: list, subject: str, content: str) -> dict:
+    """
+    Function to send a mail to many recipients, in as few requests as possible
+    :param from_user: Sender, as accepted by `utils.send_mail`
+    :param recipients: List of `Recipient`s
+    :param subject: Subject of the mail
+    :param content: HTML content of the mail, which may contain substitution tags
+    :return: Dictionary of the key of each recipient, mapped to (success, reason if failure)
+    """
+    # Bail out if SendGrid API key has not been set
+    if SENDGRID_API_KEY is None:
+        return {r.key: (False, 'SendGrid has not been set up') for r in recipients}
+
+    results = {}
+    with ThreadPoolExecutor(MAIL_CONCURRENCY) as executor:
+        futures = [
+            (batch, executor.submit(send_batch, from_user, batch, subject, content))
+            for batch in batches(recipients)
+        ]
+        for batch, future in futures:
+            success, reason = future.result()
+            if not success:
+                log(f'Could not send mail to {len(batch)} recipients - {reason}')
+            for recipient in batch:
+                results[recipient.key] = (success, reason)
+    return results
+
+
+def run_mail_job() -> int:
+    """
+    Function to send the next chunk of the oldest unfinished mail job
+    :return: Number of users handled, 0 if there was nothing to do
+    """
+    # The row stays locked while the chunk is sent, so that no other worker picks the same chunk
+    job = (
+        MailJob.query.filter(MailJob.status.in_(('pending', 'running')))
+        .order_by(MailJob.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        db.session.rollback()
+        return 0
+
+    now = datetime.utcnow()
+    if job.started_at is None:
+        job.started_at = now
+        job.status = 'running'
+
+    table = get_table_by_name(job.table_name)
+    if table is None:
+        job.status = 'failed'
+        job.last_error = f'Table {job.table_name} does not exist'
+        job.finished_at = now
+        db.session.commit()
+        return 0
+
+    query = table.query.filter(table.id > job.cursor)
+    if job.ids:
+        query = query.filter(table.id.in_([int(i) for i in job.ids.split()]))
+    users = query.order_by(table.id).limit(MAIL_JOB_CHUNK_SIZE).all()
+    if not users:
+        job.status = 'done'
+        job.finished_at = now
+        db.session.commit()
+        log(
+            f'Mail job <code>{job.id}</code> with subject <code>{job.subject}</code> to <code>{job.table_name}</code> is done! {job.sent} sent, {job.failed} failed'
+        )
+        return 0
+
+    fields = job.fields.split(',') if job.fields else []
+    results = send_bulk_mail(
+        job.from_email, recipients_for(users, fields), job.subject, job.content
+    )
+    failed_ids = []
+    for key, (success, reason) in results.items():
+        if success:
+            job.sent += 1
+        else:
+            job.failed += 1
+            job.last_error = reason
+            failed_ids.append(str(key))
+    if failed_ids:
+        job.failed_ids = ' '.join(filter(None, [job.failed_ids, *failed_ids]))
+    job.cursor = users[-1].id
+    db.session.commit()
+    return len(users)
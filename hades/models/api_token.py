@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from hades import db
+
+
+class ApiToken(db.Model):
+    """
+    Database model class
+
+    A token which an external application authenticates with instead of a password. Only the SHA-256 digest of the
+    token is stored. `events` optionally limits the token to some of the events its user has access to
+    """
+
+    __tablename__ = 'api_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False, unique=True)
+    username = db.Column(
+        db.String(20), db.ForeignKey('users.username'), nullable=False, index=True
+    )
+    name = db.Column(db.String(50), nullable=False)
+    events = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @property
+    def scope(self):
+        """Returns the set of events the token is limited to, None if it isn't"""
+        return set(self.events.split(',')) if self.events else None
+
+    def to_json(self) -> dict:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'events': sorted(self.scope) if self.events else None,
+            'created_at': self.created_at,
+        }
+
+    def __repr__(self):
+        return '%r' % [self.id, self.username, self.name, self.events]
@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from hades import db
+
+
+class Change(db.Model):
+    """
+    Database model class
+
+    A log of the rows inserted, updated and deleted through the helpers in `db_utils`. `seq` only ever grows, so
+    clients can ask for everything that changed after the last sequence number they have seen
+    """
+
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_table_seq', 'table_name', 'seq'),)
+
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.String(80), nullable=False)
+    op = db.Column(db.String(6), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '%r' % [self.seq, self.table_name, self.row_id, self.op]
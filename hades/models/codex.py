@@ -1,8 +1,6 @@
 from hades import db
-
-from requests import get
-
 from hades.models.validate import ValidateMixin
+from hades.profiles import verifier
 
 
 class CodexApril2019(ValidateMixin, db.Model):
@@ -60,6 +58,10 @@ class CodexDecember2019(ValidateMixin, db.Model):
     hackerrank_username = db.Column(db.String(50), unique=True)
     paid = db.Column(db.String(20))
 
+    unique_fields = {
+        'hackerrank_username': "Someone has already registered with hackerrank username <code>{}</code>.<br/>Kindly contact the team if that is your username and it wasn't your registration"
+    }
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -73,19 +75,15 @@ class CodexDecember2019(ValidateMixin, db.Model):
         ]
 
     def validate(self):
-        if (
-            get(f'https://hackerrank.com/{self.hackerrank_username}')
-            .content.decode()
-            .count(self.hackerrank_username)
-            < 3
-        ):
+        # Look the profile up while the database checks run
+        profile = verifier.verify_async(self.hackerrank_username)
+        message = super().validate()
+        exists = verifier.result(profile)
+        if exists is None:
+            return "We couldn't check your hackerrank profile right now, please try again in a bit!"
+        if not exists:
             return f"Your hackerrank profile doesn't seem to exist!"
-
-        if self.query.filter(
-            CodexDecember2019.hackerrank_username == self.hackerrank_username
-        ).first():
-            return f"Someone has already registered with hackerrank username <code>{self.hackerrank_username}</code>.<br/>Kindly contact the team if that is your username and it wasn't your registration"
-        return super().validate()
+        return message
 
 
 class BOV2020(ValidateMixin, db.Model):
@@ -101,6 +99,10 @@ class BOV2020(ValidateMixin, db.Model):
     hackerrank_username = db.Column(db.String(50), unique=True)
     country = db.Column(db.String(24))
 
+    unique_fields = {
+        'hackerrank_username': "Someone has already registered with hackerrank username <code>{}</code>.<br/>Kindly contact the team if that is your username and it wasn't your registration"
+    }
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -112,16 +114,12 @@ class BOV2020(ValidateMixin, db.Model):
         ]
 
     def validate(self):
-        if (
-            get(f'https://hackerrank.com/{self.hackerrank_username}')
-            .content.decode()
-            .count(self.hackerrank_username)
-            < 3
-        ):
+        # Look the profile up while the database checks run
+        profile = verifier.verify_async(self.hackerrank_username)
+        message = super().validate()
+        exists = verifier.result(profile)
+        if exists is None:
+            return "We couldn't check your hackerrank profile right now, please try again in a bit!"
+        if not exists:
             return f"Your hackerrank profile doesn't seem to exist!"
-
-        if self.query.filter(
-            BOV2020.hackerrank_username == self.hackerrank_username
-        ).first():
-            return f"Someone has already registered with hackerrank username <code>{self.hackerrank_username}</code>.<br/>Kindly contact the team if that is your username and it wasn't your registration"
-        return super().validate()
+        return message
@@ -0,0 +1,274 @@
+from typing import Union
+
+from sqlalchemy import event, exists, inspect, select
+from sqlalchemy.exc import IntegrityError
+
+from hades import db
+from hades.models.phone_number import normalize_phone
+
+# Length of the first names kept in the directory. Event tables allow longer names, which are cut to fit
+NAME_LENGTH = 30
+
+
+def contact_for(name: str, phone: str) -> Union[tuple, None]:
+    """
+    Function to get the contact a registration is listed under in the directory
+    :param name: The `name` column of the registration
+    :param phone: The `phone` column of the registration, which can hold multiple numbers separated by `|`
+    :return: (normalized phone number, title cased first name), None for team registrations and incomplete rows
+    """
+    if not name or not phone or ',' in name:
+        return None
+    numbers = phone.split('|')
+    # Of two numbers, the second one is the one to reach people at
+    number = normalize_phone(numbers[1] if len(numbers) == 2 else numbers[0])
+    first_name = name.split(' ')[0].title()[:NAME_LENGTH]
+    if not number or not first_name:
+        return None
+    return number, first_name
+
+
+class Contact(db.Model):
+    """
+    Database model class
+
+    The directory of everyone who registered for any event, one row per phone number and first name. It is kept up
+    to date as registrations are added, changed and deleted, so that it never has to be built from the event tables
+    """
+
+    __tablename__ = 'contacts'
+    __table_args__ = (db.UniqueConstraint('phone', 'name', name='uq_contacts'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    phone = db.Column(db.String(10), nullable=False)
+    name = db.Column(db.String(NAME_LENGTH), nullable=False)
+
+    @classmethod
+    def rebuild(cls, table):
+        """
+        Rebuilds the contacts of the given table, for rows which were added before the directory existed
+        :param table: The table class
+        """
+        sources = ContactSource.__table__
+        db.session.execute(
+            sources.delete().where(sources.c.table_name == table.__tablename__)
+        )
+        found = {}
+        for row_id, name, phone in db.session.query(table.id, table.name, table.phone):
+            contact = contact_for(name, phone)
+            if contact is not None:
+                found[row_id] = contact
+
+        known = dict(
+            ((phone, name), id_)
+            for id_, phone, name in db.session.execute(
+                select(cls.id, cls.phone, cls.name)
+            )
+        )
+        missing = set(found.values()) - set(known)
+        if missing:
+            db.session.execute(
+                cls.__table__.insert(),
+                [{'phone': phone, 'name': name} for phone, name in missing],
+            )
+            known.update(
+                ((phone, name), id_)
+                for id_, phone, name in db.session.execute(
+                    select(cls.id, cls.phone, cls.name)
+                )
+            )
+        if found:
+            db.session.execute(
+                sources.insert(),
+                [
+                    {
+                        'table_name': table.__tablename__,
+                        'row_id': row_id,
+                        'contact_id': known[contact],
+                    }
+                    for row_id, contact in found.items()
+                ],
+            )
+        db.session.execute(
+            cls.__table__.delete().where(
+                ~exists().where(sources.c.contact_id == cls.id)
+            )
+        )
+        db.session.commit()
+
+    def __repr__(self):
+        return '%r' % [self.id, self.phone, self.name]
+
+
+class ContactSource(db.Model):
+    """
+    Database model class
+
+    Links every registration to the contact it is listed under
+    """
+
+    __tablename__ = 'contact_sources'
+    __table_args__ = (db.Index('ix_contact_sources_contact', 'contact_id'),)
+
+    table_name = db.Column(db.String(50), primary_key=True)
+    row_id = db.Column(db.Integer, primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contacts.id'), nullable=False)
+
+    def __repr__(self):
+        return '%r' % [self.table_name, self.row_id, self.contact_id]
+
+
+def _is_registration(mapper) -> bool:
+    if mapper.class_ is Contact:
+        return False
+    return all(column in mapper.columns for column in ('id', 'name', 'phone'))
+
+
+def add_contact(connection, table_name: str, row_id: int, name: str, phone: str):
+    """Lists a registration in the directory, adding its contact if it is the first one"""
+    contact = contact_for(name, phone)
+    if contact is None:
+        return
+    contacts = Contact.__table__
+    query = (
+        select(contacts.c.id)
+        .where(contacts.c.phone == contact[0])
+        .where(contacts.c.name == contact[1])
+    )
+    contact_id = connection.execute(query).scalar()
+    if contact_id is None:
+        try:
+            with connection.begin_nested():
+                contact_id = connection.execute(
+                    contacts.insert().values(phone=contact[0], name=contact[1])
+                ).inserted_primary_key[0]
+        except IntegrityError:
+            # Someone else with the same contact registered at the same time
+            contact_id = connection.execute(query).scalar()
+    connection.execute(
+        ContactSource.__table__.insert().values(
+            table_name=table_name, row_id=row_id, contact_id=contact_id
+        )
+    )
+
+
+def remove_contact(connection, table_name: str, row_id: int):
+    """Removes a registration from the directory, along with its contact if it was the last one"""
+    sources = ContactSource.__table__
+    contacts = Contact.__table__
+    contact_id = connection.execute(
+        select(sources.c.contact_id)
+        .where(sources.c.table_name == table_name)
+        .where(sources.c.row_id == row_id)
+    ).scalar()
+    if contact_id is None:
+        return
+    connection.execute(
+        sources.delete()
+        .where(sources.c.table_name == table_name)
+        .where(sources.c.row_id == row_id)
+    )
+    connection.execute(
+        contacts.delete()
+        .where(contacts.c.id == contact_id)
+        .where(~exists().where(sources.c.contact_id == contact_id))
+    )
+
+
+def add_contacts(connection, table_name: str, rows: list):
+    """
+    Lists registrations added in bulk in the directory, adding the contacts which are new
+    :param connection: Connection or session the registrations were added in
+    :param table_name: Name of the table
+    :param rows: Dictionaries with the `id`, `name` and `phone` of every registration
+    """
+    found = {}
+    for row in rows:
+        contact = contact_for(row.get('name'), row.get('phone'))
+        if contact is not None:
+            found[row['id']] = contact
+    if not found:
+        return
+    contacts = Contact.__table__
+    query = select(contacts.c.id, contacts.c.phone, contacts.c.name).where(
+        contacts.c.phone.in_({phone for phone, _ in found.values()})
+    )
+    known = {(phone, name): id_ for id_, phone, name in connection.execute(query)}
+    missing = set(found.values()) - set(known)
+    if missing:
+        try:
+            with connection.begin_nested():
+                connection.execute(
+                    contacts.insert(),
+                    [{'phone': phone, 'name': name} for phone, name in missing],
+                )
+        except IntegrityError:
+            # Someone else with one of these contacts registered at the same time
+            for phone, name in missing:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(
+                            contacts.insert().values(phone=phone, name=name)
+                        )
+                except IntegrityError:
+                    pass
+        known = {(phone, name): id_ for id_, phone, name in connection.execute(query)}
+    connection.execute(
+        ContactSource.__table__.insert(),
+        [
+            {'table_name': table_name, 'row_id': row_id, 'contact_id': known[contact]}
+            for row_id, contact in found.items()
+        ],
+    )
+
+
+def remove_contacts(connection, table_name: str, row_ids: list = None):
+    """
+    Removes registrations deleted in bulk from the directory, along with contacts which were only theirs
+    :param connection: Connection or session the registrations were deleted in
+    :param table_name: Name of the table
+    :param row_ids: IDs of the registrations, None if all of them were deleted
+    """
+    sources = ContactSource.__table__
+    contacts = Contact.__table__
+    condition = sources.c.table_name == table_name
+    if row_ids is not None:
+        condition &= sources.c.row_id.in_(row_ids)
+    contact_ids = connection.execute(select(sources.c.contact_id).where(condition))
+    contact_ids = list(set(contact_ids.scalars()))
+    if not contact_ids:
+        return
+    connection.execute(sources.delete().where(condition))
+    connection.execute(
+        contacts.delete()
+        .where(contacts.c.id.in_(contact_ids))
+        .where(~exists().where(sources.c.contact_id == contacts.c.id))
+    )
+
+
+@event.listens_for(db.Model, 'after_insert', propagate=True)
+def list_contact(mapper, connection, target):
+    """Adds a new registration to the directory"""
+    if not _is_registration(mapper):
+        return
+    add_contact(connection, target.__tablename__, target.id, target.name, target.phone)
+
+
+@event.listens_for(db.Model, 'after_update', propagate=True)
+def relist_contact(mapper, connection, target):
+    """Moves a registration whose name or phone number was changed to its new contact"""
+    if not _is_registration(mapper):
+        return
+    attrs = inspect(target).attrs
+    if not (attrs.name.history.has_changes() or attrs.phone.history.has_changes()):
+        return
+    remove_contact(connection, target.__tablename__, target.id)
+    add_contact(connection, target.__tablename__, target.id, target.name, target.phone)
+
+
+@event.listens_for(db.Model, 'after_delete', propagate=True)
+def unlist_contact(mapper, connection, target):
+    """Removes a deleted registration from the directory"""
+    if not _is_registration(mapper):
+        return
+    remove_contact(connection, target.__tablename__, target.id)
@@ -16,6 +16,8 @@ class CSINovember2019(ValidateMixin, db.Model):
     year = db.Column(db.String(3))
     csi_id = db.Column(db.String(3), unique=True)
 
+    unique_fields = {'csi_id': 'CSI ID {} is already registered in the database'}
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -27,11 +29,6 @@ class CSINovember2019(ValidateMixin, db.Model):
             self.csi_id,
         ]
 
-    def validate(self):
-        if self.query.filter(CSINovember2019.csi_id == self.csi_id).first():
-            return f'CSI ID {self.csi_id} is already registered in the database'
-        return super().validate()
-
 
 class CSINovemberNonMember2019(ValidateMixin, db.Model):
     """
@@ -48,6 +45,8 @@ class CSINovemberNonMember2019(ValidateMixin, db.Model):
     prn = db.Column(db.String(10), unique=True)
     paid = db.Column(db.String(20))
 
+    unique_fields = {'prn': 'PRN {} is already registered in the database'}
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -58,8 +57,3 @@ class CSINovemberNonMember2019(ValidateMixin, db.Model):
             self.year,
             self.prn,
         ]
-
-    def validate(self):
-        if self.query.filter(CSINovemberNonMember2019.prn == self.prn).first():
-            return f'PRN {self.prn} is already registered in the database'
-        return super().validate()
@@ -5,9 +5,14 @@ from hades.models.validate import ValidateMixin
 class Events(ValidateMixin, db.Model):
     """
     Database model class
+
+    `fields` optionally holds the schema of the table of an event as JSON, for events without a model written as code
+    (see `hades.registry`). Events which are `active` take registrations
     """
 
     __tablename__ = 'events'
 
     name = db.Column(db.String(50), primary_key=True)
     full_name = db.Column(db.String(60), unique=True)
+    fields = db.Column(db.Text)
+    active = db.Column(db.Boolean, nullable=False, default=False)
@@ -18,6 +18,8 @@ class Coursera2020(ValidateMixin, db.Model):
     program = db.Column(db.String(35))
     year = db.Column(db.Integer())
 
+    unique_fields = {'prn': 'PRN {} is already registered in the database'}
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -30,8 +32,3 @@ class Coursera2020(ValidateMixin, db.Model):
             self.program,
             self.year,
         ]
-
-    def validate(self):
-        if self.query.filter(Coursera2020.prn == self.prn).first():
-            return f'PRN {self.prn} is already registered in the database'
-        return super().validate()
@@ -0,0 +1,16 @@
+from hades import db
+
+
+class IdCounter(db.Model):
+    """
+    Database model class
+
+    Holds the last ID that has been handed out for each table, see `db_utils.allocate_id`
+    """
+
+    __tablename__ = 'id_counters'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '%r' % [self.name, self.value]
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from hades import db
+
+
+class MailJob(db.Model):
+    """
+    Database model class
+
+    A bulk mail to the users of a table, sent in chunks by `hades.worker`. `cursor` is the highest user ID that has
+    been handled so far, so a restarted worker continues after it
+    """
+
+    __tablename__ = 'mail_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    ids = db.Column(db.Text)
+    from_email = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    fields = db.Column(db.Text, nullable=False, default='')
+    created_by = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    failed_ids = db.Column(db.Text, nullable=False, default='')
+    last_error = db.Column(db.Text)
+    cursor = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_json(self) -> dict:
+        """Returns the progress of the job"""
+        ret = {
+            'id': self.id,
+            'table': self.table_name,
+            'status': self.status,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'remaining': max(self.total - self.sent - self.failed, 0),
+            'failed_ids': [int(i) for i in self.failed_ids.split()],
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at and self.started_at.isoformat(),
+            'finished_at': self.finished_at and self.finished_at.isoformat(),
+            'throughput': None,
+        }
+        # Recipients handled per second since the job started
+        if self.started_at is not None:
+            elapsed = (
+                (self.finished_at or datetime.utcnow()) - self.started_at
+            ).total_seconds()
+            if elapsed > 0:
+                ret['throughput'] = round((self.sent + self.failed) / elapsed, 2)
+        return ret
+
+    def __repr__(self):
+        return '%r' % [self.id, self.table_name, self.status, self.sent, self.failed]
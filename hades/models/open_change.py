@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from hades import db
+
+
+class OpenChange(db.Model):
+    """
+    Database model class
+
+    One row for every transaction which is writing to the change log and hasn't committed yet, deleted as part of it.
+    `floor` is the highest sequence number committed when it started, so every change it writes comes after it
+    """
+
+    __tablename__ = 'open_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    floor = db.Column(db.Integer, nullable=False)
+    opened_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '%r' % [self.id, self.floor, self.opened_at]
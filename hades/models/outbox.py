@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from hades import db
+
+
+class Outbox(db.Model):
+    """
+    Database model class
+
+    Every row is a side effect (an email or a Telegram notification) which is to be performed once the transaction
+    which created it has been committed. The rows are drained by `hades.worker`
+    """
+
+    __tablename__ = 'outbox'
+    __table_args__ = (db.Index('ix_outbox_due', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '%r' % [self.id, self.kind, self.status, self.attempts]
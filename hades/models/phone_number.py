@@ -0,0 +1,62 @@
+from hades import db
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    Function to bring a phone number into the form in which it is indexed
+    :param phone: The phone number as entered in the form
+    :return: Only the digits of the number, without any country code prefix
+    """
+    digits = ''.join(c for c in str(phone) if c.isdigit())
+    return digits[-10:]
+
+
+class PhoneNumber(db.Model):
+    """
+    Database model class
+
+    Holds one row per phone number of a registration, as the `phone` column of event tables can hold multiple numbers
+    separated by `|`. This lets duplicate numbers be found with an index lookup instead of a `LIKE` over the whole table
+    """
+
+    __tablename__ = 'phone_numbers'
+    __table_args__ = (
+        db.Index('ix_phone_numbers_phone', 'table_name', 'phone'),
+        db.Index('ix_phone_numbers_row', 'table_name', 'row_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    phone = db.Column(db.String(21), nullable=False)
+
+    @staticmethod
+    def rows_for(table_name: str, row_id: int, phone: str) -> list:
+        """Returns the rows to be indexed for the given value of a `phone` column"""
+        if not phone:
+            return []
+        numbers = {normalize_phone(num) for num in phone.split('|')}
+        return [
+            {'table_name': table_name, 'row_id': row_id, 'phone': num}
+            for num in numbers
+            if num
+        ]
+
+    @classmethod
+    def rebuild(cls, table):
+        """
+        Rebuilds the phone numbers indexed for the given table, for rows which were added before the index existed
+        :param table: The table class
+        """
+        db.session.execute(
+            cls.__table__.delete().where(cls.table_name == table.__tablename__)
+        )
+        rows = []
+        for row_id, phone in db.session.query(table.id, table.phone):
+            rows += cls.rows_for(table.__tablename__, row_id, phone)
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+
+    def __repr__(self):
+        return '%r' % [self.table_name, self.row_id, self.phone]
@@ -0,0 +1,18 @@
+from hades import db
+
+
+class ProfileCache(db.Model):
+    """
+    Database model class
+
+    Caches whether a profile on an external service (for example a HackerRank username) exists, see `hades.profiles`
+    """
+
+    __tablename__ = 'profile_cache'
+    service = db.Column(db.String(20), primary_key=True)
+    username = db.Column(db.String(50), primary_key=True)
+    found = db.Column(db.Boolean, nullable=False)
+    checked_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '%r' % [self.service, self.username, self.found, self.checked_at]
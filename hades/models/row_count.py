@@ -0,0 +1,16 @@
+from hades import db
+
+
+class RowCount(db.Model):
+    """
+    Database model class
+
+    Caches the number of rows of each table, kept up to date by the helpers in `db_utils`
+    """
+
+    __tablename__ = 'row_counts'
+    name = db.Column(db.String(50), primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '%r' % [self.name, self.row_count]
@@ -0,0 +1,17 @@
+from hades import db
+
+
+class TableVersion(db.Model):
+    """
+    Database model class
+
+    Holds a number for each table which is increased by the helpers in `db_utils` whenever a row of it is changed, so
+    that responses built from a table can be cached until it changes
+    """
+
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '%r' % [self.name, self.version]
@@ -1,11 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from decouple import config
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
 
 from hades import app, db
+from hades.telegram import LatencyHistogram
+
+# Work factor of new password hashes. Stored hashes with a different one are rehashed when their user logs in
+BCRYPT_LOG_ROUNDS = config('BCRYPT_LOG_ROUNDS', default=12, cast=int)
+
+# Number of passwords hashed or checked at the same time by a worker
+BCRYPT_THREADS = config('BCRYPT_THREADS', default=2, cast=int)
 
 bcrypt = Bcrypt(app)
 
 
+class HashingPool:
+    """
+    Class to run password hashing on a few dedicated threads
+
+    bcrypt is slow on purpose, so at most `threads` hashes are computed at a time however many requests want one, and
+    the rest wait in line
+
+    -> run: runs the given function on the pool, and returns its result
+    -> stats: returns the number of waiting and running hashes, and a histogram of the seconds spent waiting
+    """
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='bcrypt')
+        self.queue_time = LatencyHistogram()
+        self.waiting = 0
+        self.running = 0
+        self.lock = Lock()
+
+    def run(self, function, *args):
+        submitted = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+
+        def task():
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+            self.queue_time.observe(time.monotonic() - submitted)
+            try:
+                return function(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        return self.executor.submit(task).result()
+
+    def stats(self) -> dict:
+        with self.lock:
+            counts = {'waiting': self.waiting, 'running': self.running}
+        return {**counts, 'queue_time': self.queue_time.snapshot()}
+
+
+hashing_pool = HashingPool(BCRYPT_THREADS)
+
+
+def password_cost(password_hash: str) -> int:
+    """Returns the work factor of a bcrypt hash, of the form $2b$<cost>$<salt and hash>"""
+    return int(password_hash.split('$')[2])
+
+
 class Users(db.Model, UserMixin):
     """
     Database model class
@@ -21,10 +83,17 @@ class Users(db.Model, UserMixin):
         return self.username if self is not None else None
 
     def check_password_hash(self, password: str) -> bool:
-        return bcrypt.check_password_hash(self.password, password)
+        return hashing_pool.run(bcrypt.check_password_hash, self.password, password)
+
+    def needs_rehash(self) -> bool:
+        """Returns whether the stored hash has a different work factor than new ones"""
+        return password_cost(self.password) != BCRYPT_LOG_ROUNDS
 
     def generate_password_hash(self, password: str):
-        self.password = bcrypt.generate_password_hash(password).decode('utf-8')
+        password_hash = hashing_pool.run(
+            bcrypt.generate_password_hash, password, BCRYPT_LOG_ROUNDS
+        )
+        self.password = password_hash.decode('utf-8')
 
     def __repr__(self):
         return '%r' % [self.username, self.name, self.email]
@@ -1,20 +1,182 @@
 from typing import Union
 
+from sqlalchemy import event, exists, inspect, select
+
 from hades import db
+from hades.models.phone_number import PhoneNumber, normalize_phone
 
 
 class ValidateMixin(object):
-    def validate(self) -> Union[str, bool]:
+    # Columns besides `email` and `phone` that must not be repeated, mapped to the message shown when they are
+    unique_fields = {}
+
+    def find_conflicts(self) -> dict:
+        """
+        Checks all the unique fields of this object against its table in a single query
+        :return: Dictionary of the fields which are already registered, mapped to the values which collided
+        """
         table = self.__class__
-        # Ensure nobody else in the table has the same email address
-        if self.query.filter(table.email == self.email).first():
-            return f'Email address {self.email} already found in database! Please re-enter the form correctly!'
+        checks = []
+        values = {}
+        for field in (*self.unique_fields, 'email'):
+            value = getattr(self, field)
+            if value is None or value == '':
+                continue
+            values[field] = value
+            checks.append(exists().where(getattr(table, field) == value).label(field))
+
+        # Numbers are looked up in their normalized form, but reported as they were entered
+        numbers = {normalize_phone(num): num for num in self.phone.split('|')}
+        checks.append(
+            select(PhoneNumber.phone)
+            .where(PhoneNumber.table_name == table.__tablename__)
+            .where(PhoneNumber.phone.in_(numbers))
+            .limit(1)
+            .scalar_subquery()
+            .label('phone')
+        )
+
+        result = db.session.execute(select(*checks)).one()._mapping
+        conflicts = {field: value for field, value in values.items() if result[field]}
+        if result['phone'] is not None:
+            conflicts['phone'] = numbers[result['phone']]
+        return conflicts
+
+    @classmethod
+    def message_for(cls, field: str, value) -> str:
+        """Returns the message to be shown when the given value of a unique field is already registered"""
+        if field == 'email':
+            return f'Email address {value} already found in database! Please re-enter the form correctly!'
+        if field == 'phone':
+            return f'Phone number {value} already found in database! Please re-enter the form correctly!'
+        return cls.unique_fields[field].format(value)
+
+    def conflict_message(self) -> Union[str, None]:
+        """Returns the message to be shown for the first field that collided, None if there were no collisions"""
+        for field, value in self.find_conflicts().items():
+            return self.message_for(field, value)
+        return None
+
+    @classmethod
+    def check_batch(cls, rows: list, own_ids: list = None) -> list:
+        """
+        Checks many rows against the table and against each other, with a single query per unique field
+        :param rows: Dictionaries of the values to be written, only the fields given are checked
+        :param own_ids: For updates, the ID of the row each one is written to, whose own values don't collide
+        :return: For every row, the message for the first field that collided, None if there were no collisions
+        """
+        fields = (*cls.unique_fields, 'email')
+        # Field -> value -> ID of the row holding it
+        taken = {}
+        for field in fields:
+            values = {row[field] for row in rows if row.get(field) not in (None, '')}
+            column = getattr(cls, field)
+            taken[field] = {}
+            if values:
+                taken[field] = dict(
+                    db.session.execute(
+                        select(column, cls.id).where(column.in_(values))
+                    ).all()
+                )
+
+        # Numbers are looked up in their normalized form, but reported as they were entered
+        numbers = []
+        for row in rows:
+            phone = row.get('phone')
+            numbers.append(
+                {normalize_phone(num): num for num in str(phone).split('|')}
+                if phone
+                else {}
+            )
+        taken['phone'] = {}
+        normalized = set().union(*numbers)
+        if normalized:
+            taken['phone'] = dict(
+                db.session.execute(
+                    select(PhoneNumber.phone, PhoneNumber.row_id)
+                    .where(PhoneNumber.table_name == cls.__tablename__)
+                    .where(PhoneNumber.phone.in_(normalized))
+                ).all()
+            )
+
+        ret = []
+        for i, row in enumerate(rows):
+            # Rows of the batch which are yet to be created are told apart by their position
+            own = own_ids[i] if own_ids is not None else ('row', i)
+            values = {
+                field: {row[field]: row[field]}
+                for field in fields
+                if row.get(field) not in (None, '')
+            }
+            if numbers[i]:
+                values['phone'] = numbers[i]
+            message = next(
+                (
+                    f'Phone number {num} is too short! Please re-enter the form correctly!'
+                    for num in numbers[i].values()
+                    if len(str(num)) < 10
+                ),
+                None,
+            )
+            for field, found in values.items():
+                if message is not None:
+                    break
+                for key, value in found.items():
+                    if taken[field].get(key, own) != own:
+                        message = cls.message_for(field, value)
+                        break
+            if message is None:
+                # Later rows of the batch may not take the values of this one
+                for field, found in values.items():
+                    taken[field].update(dict.fromkeys(found, own))
+            ret.append(message)
+        return ret
 
-        # Ensure nobody else in the table has the same phone number
+    def validate(self) -> Union[str, bool]:
         for num in self.phone.split('|'):
             if len(str(num)) < 10:
                 return f'Phone number {num} is too short! Please re-enter the form correctly!'
-            if self.query.filter(table.phone.like(f'%{num}%')).first():
-                return f'Phone number {num} already found in database! Please re-enter the form correctly!'
+
+        # Ensure nobody else in the table has the same email address, phone number, or any other unique field
+        message = self.conflict_message()
+        if message is not None:
+            return message
 
         return True
+
+
+def _has_phone(mapper) -> bool:
+    return 'phone' in mapper.columns and 'id' in mapper.columns
+
+
+@event.listens_for(ValidateMixin, 'after_insert', propagate=True)
+def index_phone_numbers(mapper, connection, target):
+    """Adds the phone numbers of a new row to the `phone_numbers` table"""
+    if not _has_phone(mapper):
+        return
+    rows = PhoneNumber.rows_for(target.__tablename__, target.id, target.phone)
+    if rows:
+        connection.execute(PhoneNumber.__table__.insert(), rows)
+
+
+@event.listens_for(ValidateMixin, 'after_update', propagate=True)
+def reindex_phone_numbers(mapper, connection, target):
+    """Replaces the indexed phone numbers of a row whose `phone` was changed"""
+    if not _has_phone(mapper):
+        return
+    if not inspect(target).attrs.phone.history.has_changes():
+        return
+    unindex_phone_numbers(mapper, connection, target)
+    index_phone_numbers(mapper, connection, target)
+
+
+@event.listens_for(ValidateMixin, 'after_delete', propagate=True)
+def unindex_phone_numbers(mapper, connection, target):
+    """Removes the phone numbers of a deleted row from the `phone_numbers` table"""
+    if not _has_phone(mapper):
+        return
+    connection.execute(
+        PhoneNumber.__table__.delete()
+        .where(PhoneNumber.table_name == target.__tablename__)
+        .where(PhoneNumber.row_id == target.id)
+    )
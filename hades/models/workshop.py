@@ -86,6 +86,11 @@ class CNovember2019(ValidateMixin, db.Model):
     prn = db.Column(db.Integer, unique=True)
     roll = db.Column(db.String(4), unique=True)
 
+    unique_fields = {
+        'prn': 'PRN {} has already been registered!',
+        'roll': 'Roll number {} has already been registered!',
+    }
+
     def __repr__(self):
         return '%r' % [
             self.id,
@@ -100,10 +105,9 @@ class CNovember2019(ValidateMixin, db.Model):
     def validate(self):
         if self.year == '2nd':
             return super().validate()
-        if self.query.filter(CNovember2019.prn == self.prn).first():
-            return f'PRN {self.prn} has already been registered!'
-        if self.query.filter(CNovember2019.roll == self.roll).first():
-            return f'Roll number {self.roll} has already been registered!'
+        message = self.conflict_message()
+        if message is not None:
+            return message
         return 'This workshop is <b>only</b> for SY students'
 
 
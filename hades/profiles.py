@@ -0,0 +1,173 @@
+"""
+Verification of profiles on external services, such as the HackerRank usernames entered in registration forms
+
+Lookups run on a small thread pool so that they overlap with the database checks of a registration. Their results are
+cached in the `profile_cache` table, which is shared by all workers, so resubmissions don't hit the service again
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import cached_property
+from datetime import datetime, timedelta
+from typing import Union
+
+from decouple import Csv, config
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from hades import db
+from hades.models.profile_cache import ProfileCache
+
+# Backend used to look profiles up, `hackerrank` or `stub`
+PROFILE_BACKEND = config('PROFILE_BACKEND', default='hackerrank')
+
+# Seconds to wait for a connection to the service, and for its response
+PROFILE_CONNECT_TIMEOUT = config('PROFILE_CONNECT_TIMEOUT', default=3.0, cast=float)
+PROFILE_READ_TIMEOUT = config('PROFILE_READ_TIMEOUT', default=5.0, cast=float)
+
+# Seconds for which profiles that exist, and profiles that don't, are cached
+PROFILE_POSITIVE_TTL = config('PROFILE_POSITIVE_TTL', default=86400, cast=int)
+PROFILE_NEGATIVE_TTL = config('PROFILE_NEGATIVE_TTL', default=600, cast=int)
+
+# Number of lookups which may run at the same time in a worker
+PROFILE_THREADS = config('PROFILE_THREADS', default=4, cast=int)
+
+# Usernames which the stub backend reports as missing, every other username exists
+PROFILE_STUB_MISSING = config('PROFILE_STUB_MISSING', default='', cast=Csv())
+
+
+class ProfileLookupError(Exception):
+    """Raised by backends when the service could not be reached"""
+
+
+class HackerRankBackend:
+    """Looks profiles up on hackerrank.com, over a pooled HTTP session"""
+
+    service = 'hackerrank'
+
+    @cached_property
+    def session(self):
+        # Imported here so that workers which never look a profile up don't import requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_maxsize=PROFILE_THREADS))
+        return session
+
+    def exists(self, username: str) -> bool:
+        import requests
+
+        try:
+            response = self.session.get(
+                f'https://hackerrank.com/{username}',
+                timeout=(PROFILE_CONNECT_TIMEOUT, PROFILE_READ_TIMEOUT),
+            )
+        except requests.RequestException as e:
+            raise ProfileLookupError(e) from e
+        return response.content.decode().count(username) >= 3
+
+
+class StubBackend:
+    """Looks profiles up without any network access, for testing"""
+
+    service = 'stub'
+
+    def exists(self, username: str) -> bool:
+        return username not in PROFILE_STUB_MISSING
+
+
+BACKENDS = {
+    'hackerrank': HackerRankBackend,
+    'stub': StubBackend,
+}
+
+
+class ProfileVerifier:
+    """
+    Checks whether profiles exist on the service of the given backend, caching the results
+
+    -> verify: looks a username up, returns True/False, or None if the service could not be reached
+    -> verify_async: runs `verify` on the thread pool and returns a future
+    -> result: waits for such a future, giving up after the configured timeouts
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(PROFILE_THREADS)
+
+    def cached(self, username: str) -> Union[bool, None]:
+        """Returns the cached result for `username`, None if there is no fresh one"""
+        cache = ProfileCache.__table__
+        try:
+            with db.engine.connect() as connection:
+                row = connection.execute(
+                    select(cache.c.found, cache.c.checked_at)
+                    .where(cache.c.service == self.backend.service)
+                    .where(cache.c.username == username)
+                ).first()
+        except SQLAlchemyError as e:
+            # The lookup then goes to the service
+            print(e, e.__class__)
+            return None
+        if row is None:
+            return None
+        ttl = PROFILE_POSITIVE_TTL if row.found else PROFILE_NEGATIVE_TTL
+        if row.checked_at + timedelta(seconds=ttl) < datetime.utcnow():
+            return None
+        return row.found
+
+    def store(self, username: str, exists: bool):
+        """Caches the result for `username`, which is only skipped if the database fails"""
+        cache = ProfileCache.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    cache.delete()
+                    .where(cache.c.service == self.backend.service)
+                    .where(cache.c.username == username)
+                )
+                connection.execute(
+                    cache.insert().values(
+                        service=self.backend.service,
+                        username=username,
+                        found=exists,
+                        checked_at=datetime.utcnow(),
+                    )
+                )
+        except SQLAlchemyError as e:
+            # Like another lookup of the same username storing its result at the same time
+            print(e, e.__class__)
+
+    def verify(self, username: str) -> Union[bool, None]:
+        username = (username or '').strip()
+        if not username:
+            return False
+        exists = self.cached(username.lower())
+        if exists is not None:
+            return exists
+        try:
+            exists = self.backend.exists(username)
+        except ProfileLookupError as e:
+            print(e, e.__class__)
+            return None
+        self.store(username.lower(), exists)
+        return exists
+
+    def verify_async(self, username: str):
+        return self.executor.submit(self.verify, username)
+
+    @staticmethod
+    def result(future) -> Union[bool, None]:
+        try:
+            return future.result(
+                timeout=PROFILE_CONNECT_TIMEOUT + PROFILE_READ_TIMEOUT + 1
+            )
+        except TimeoutError:
+            return None
+        except Exception as e:
+            # A failed lookup is treated like an unreachable service, rather than failing the registration
+            print(e, e.__class__)
+            return None
+
+
+verifier = ProfileVerifier(BACKENDS[PROFILE_BACKEND]())
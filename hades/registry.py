@@ -0,0 +1,184 @@
+import time
+from collections.abc import Mapping
+from importlib import import_module
+from json import loads
+from threading import RLock
+
+from decouple import config
+from sqlalchemy import select
+
+from hades import db
+from hades.db_utils import get_versions
+from hades.models.event import Events
+from hades.models.validate import ValidateMixin
+
+# Seconds in between checks of whether the `events` table was changed, for new events and events (de)activated
+EVENT_RELOAD_INTERVAL = config('EVENT_RELOAD_INTERVAL', default=5, cast=int)
+
+# Seconds after which the events are read again even if the version of the `events` table is the same, for changes
+# made without bumping it, like by hand
+EVENT_CACHE_TTL = config('EVENT_CACHE_TTL', default=60, cast=int)
+
+# Column types which can be used in the schema of an event
+COLUMN_TYPES = {
+    'boolean': db.Boolean,
+    'datetime': db.DateTime,
+    'integer': db.Integer,
+    'string': db.String,
+    'text': db.Text,
+}
+
+
+def _repr(self):
+    return '%r' % [getattr(self, column) for column in self.__table__.columns.keys()]
+
+
+def build_model(name: str, schema: dict):
+    """
+    Function to build the model class of an event from its schema, creating its table if it doesn't exist yet
+
+    Every event has `id`, `name`, `email` and `phone` columns, the schema adds the rest (or overrides these) as
+
+        {
+            "columns": [{"name": "prn", "type": "string", "length": 10, "unique": true}, ...],
+            "unique_fields": {"prn": "PRN {} is already registered in the database"}
+        }
+
+    :param name: Name of the table
+    :param schema: The schema, as stored in the `fields` column of the `events` table
+    :return: The model class
+    :raises KeyError: if a column is missing its name or type, or the type is unknown
+    :raises TypeError: if the schema is not of the form above
+    """
+    attributes = {
+        '__tablename__': name,
+        '__doc__': 'Database model class',
+        '__repr__': _repr,
+        'id': db.Column(db.Integer, primary_key=True),
+        'name': db.Column(db.String(30)),
+        'email': db.Column(db.String(50), unique=True),
+        'phone': db.Column(db.String(21), unique=True),
+        'unique_fields': schema.get('unique_fields', {}),
+    }
+    for column in schema.get('columns', []):
+        type_ = COLUMN_TYPES[column['type']]
+        if 'length' in column:
+            type_ = type_(column['length'])
+        attributes[column['name']] = db.Column(
+            type_, unique=column.get('unique', False)
+        )
+    class_name = ''.join(part.title() for part in name.split('_'))
+    model = type(class_name, (ValidateMixin, db.Model), attributes)
+    model.__table__.create(db.engine, checkfirst=True)
+    return model
+
+
+class ModelRegistry(Mapping):
+    """
+    Class to look model classes up by the name of their table
+
+    Models written as code are given as `module:Class` paths relative to `hades.models`, and are imported on first
+    use, so that a worker which only ever serves one event doesn't import (and map) every other one. Events with a
+    schema in the `fields` column of the `events` table are built from it, and the events marked `active` take
+    registrations. The `events` table is checked for changes every EVENT_RELOAD_INTERVAL seconds, so new events show
+    up without restarting the workers. A model is built only once, so changing the schema of an event which a worker
+    already built needs a restart
+
+    -> registry[name]: returns the model class of the table
+    -> active: returns the model classes and full names of the events taking registrations
+    -> refresh: checks the `events` table for changes
+    -> import_models: imports every model written as code, for code which needs them mapped, like `db.create_all()`
+    -> load_all: imports or builds every model
+    """
+
+    def __init__(self, paths: dict):
+        self.paths = paths
+        self.models = {}
+        self.schemas = {}
+        self.active_names = []
+        self.version = None
+        self.checked_at = None
+        self.loaded_at = None
+        self.lock = RLock()
+
+    def refresh(self, force: bool = False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.checked_at is not None:
+                if now - self.checked_at < EVENT_RELOAD_INTERVAL:
+                    return
+            self.checked_at = now
+            version = get_versions(['events'])['events']
+            if (
+                not force
+                and version == self.version
+                and now - self.loaded_at < EVENT_CACHE_TTL
+            ):
+                return
+
+            active = []
+            for name, full_name, fields, is_active in db.session.execute(
+                select(Events.name, Events.full_name, Events.fields, Events.active)
+            ):
+                if fields and name not in self.paths:
+                    self.schemas[name] = fields
+                if is_active:
+                    active.append((name, full_name))
+            self.active_names = active
+            self.version = version
+            self.loaded_at = now
+
+    def __getitem__(self, name):
+        model = self.models.get(name)
+        if model is not None:
+            return model
+        with self.lock:
+            if name in self.paths:
+                module, _, class_name = self.paths[name].partition(':')
+                model = getattr(import_module(f'hades.models.{module}'), class_name)
+            else:
+                if name not in self.schemas:
+                    # Perhaps the event was added since we last checked
+                    self.refresh()
+                schema = self.schemas[name]
+                try:
+                    model = build_model(name, loads(schema))
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f'Invalid schema for event {name}:', e, e.__class__)
+                    raise KeyError(name) from e
+            self.models[name] = model
+        return model
+
+    def __iter__(self):
+        self.refresh()
+        return iter([*self.paths, *self.schemas])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, name):
+        if name in self.paths or name in self.schemas:
+            return True
+        self.refresh()
+        return name in self.schemas
+
+    def active(self) -> list:
+        self.refresh()
+        ret = []
+        for name, full_name in self.active_names:
+            try:
+                ret.append((self[name], full_name))
+            except KeyError as e:
+                # An event marked active without a model or a valid schema can't take registrations
+                print(e, e.__class__)
+        return ret
+
+    def import_models(self):
+        for name in self.paths:
+            self[name]
+
+    def load_all(self):
+        self.import_models()
+        self.refresh(force=True)
+        for name in self.schemas:
+            self[name]
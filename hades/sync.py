@@ -0,0 +1,431 @@
+"""
+Incremental copying of a database into a copy of it, for `python -m hades sync`
+
+Every table is brought up to date in three steps, each committing a chunk at a time, so a sync which was interrupted
+carries on from where it stopped when it is run again
+-> Rows with a higher integer primary key than any in the destination are copied
+-> Rows logged in the `changes` table of the source since the last sync are compared, and copied or deleted. The
+   sequence number synced up to is kept in the `sync_marks` table of the destination
+-> Both tables are split in chunks of their primary key, and the checksums of each chunk compared, computed by the
+   databases themselves on MySQL and Postgres. Only the rows of chunks which differ are read and compared one by
+   one, and fixed, which takes care of tables which aren't logged
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    and_,
+    bindparam,
+    cast,
+    create_engine,
+    func,
+    inspect,
+    literal,
+    select,
+    true,
+    tuple_,
+)
+
+from hades import db
+from hades.clone import CLONE_CHUNK_SIZE, CLONE_WORKERS, dependency_levels, get_tables
+from hades.db_utils import seed_id_counters, settled_seq
+from hades.models.change import Change
+
+# Sequence number of the change log of the source up to which each table was synced, only kept in the destination
+sync_marks = Table(
+    'sync_marks',
+    MetaData(),
+    Column('table_name', String(50), primary_key=True),
+    Column('seq', Integer, nullable=False),
+)
+
+
+def normalize(value):
+    """Returns a value in a form which compares equal across databases"""
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return str(value)
+
+
+class TableSync:
+    """
+    Class to sync one table
+
+    -> copy_new: copies rows with a higher primary key than any in the destination
+    -> replay: copies rows logged as changed since the last sync
+    -> verify: compares the checksums of the table in chunks, fixing the chunks which differ unless only checking
+    """
+
+    def __init__(self, source, dest, source_table, dest_table, chunk_size: int):
+        self.name = source_table.name
+        self.source = source
+        self.dest = dest
+        self.source_table = source_table
+        self.dest_table = dest_table
+        self.chunk_size = chunk_size
+        self.columns = [c for c in source_table.columns.keys() if c in dest_table.c]
+        # Checksums computed by the databases only compare equal if both are the same kind
+        self.dialect = (
+            source.dialect.name if source.dialect.name == dest.dialect.name else None
+        )
+        # Tables without a primary key are compared by all of their columns
+        self.keys = [c.name for c in source_table.primary_key.columns] or self.columns
+
+    def after(self, table, key: tuple):
+        """Returns a condition for rows coming after the given key"""
+        if key is None:
+            return true()
+        if len(self.keys) == 1:
+            return table.c[self.keys[0]] > key[0]
+        return tuple_(*(table.c[k] for k in self.keys)) > tuple_(*key)
+
+    def read(self, connection, table, *where, limit: int = None) -> dict:
+        """Returns the rows matching the conditions, by their normalized key"""
+        query = (
+            select(*(table.c[c] for c in self.columns))
+            .where(*where)
+            .order_by(*(table.c[k] for k in self.keys))
+            .limit(limit)
+        )
+        return {
+            tuple(normalize(row[k]) for k in self.keys): dict(row)
+            for row in connection.execute(query).mappings()
+        }
+
+    def apply(self, connection, source_rows: dict, dest_rows: dict) -> int:
+        """
+        Function to make rows in the destination match those in the source
+        :param connection: Connection to the destination, in a transaction
+        :param source_rows: Rows read from the source by `read()`
+        :param dest_rows: The same range of rows, read from the destination
+        :return: The number of rows inserted, updated and deleted
+        """
+        table = self.dest_table
+        inserts = [source_rows[k] for k in source_rows.keys() - dest_rows.keys()]
+        updates = [
+            source_rows[k]
+            for k in source_rows.keys() & dest_rows.keys()
+            if list(map(normalize, source_rows[k].values()))
+            != list(map(normalize, dest_rows[k].values()))
+        ]
+        deletes = [dest_rows[k] for k in dest_rows.keys() - source_rows.keys()]
+        by_key = and_(*(table.c[k] == bindparam(f'key_{k}') for k in self.keys))
+        if deletes:
+            connection.execute(
+                table.delete().where(by_key),
+                [{f'key_{k}': row[k] for k in self.keys} for row in deletes],
+            )
+        values = [c for c in self.columns if c not in self.keys]
+        if updates and values:
+            connection.execute(
+                table.update()
+                .where(by_key)
+                .values({c: bindparam(f'value_{c}') for c in values}),
+                [
+                    {
+                        **{f'key_{k}': row[k] for k in self.keys},
+                        **{f'value_{c}': row[c] for c in values},
+                    }
+                    for row in updates
+                ],
+            )
+        if inserts:
+            connection.execute(table.insert(), inserts)
+        return len(inserts) + len(updates) + len(deletes)
+
+    def copy_new(self) -> int:
+        """Copies rows with a higher integer primary key than any in the destination, a chunk at a time"""
+        if len(self.keys) != 1 or not isinstance(
+            self.source_table.c[self.keys[0]].type, Integer
+        ):
+            return 0
+        key = self.keys[0]
+        with self.dest.connect() as connection:
+            high = connection.execute(select(func.max(self.dest_table.c[key]))).scalar()
+        copied = 0
+        while True:
+            with self.source.connect() as connection:
+                rows = self.read(
+                    connection,
+                    self.source_table,
+                    self.after(self.source_table, None if high is None else (high,)),
+                    limit=self.chunk_size,
+                )
+            if not rows:
+                return copied
+            with self.dest.begin() as connection:
+                connection.execute(self.dest_table.insert(), list(rows.values()))
+            copied += len(rows)
+            high = list(rows.values())[-1][key]
+            print(f'{self.name}: copied {copied} new rows')
+
+    def replay(self, since: int, until: int) -> int:
+        """
+        Function to copy the rows logged as changed in between two sequence numbers of the change log, a chunk at a time
+        :return: The number of rows inserted, updated and deleted
+        """
+        changes = Change.__table__
+        key = self.keys[0]
+        cast = int if isinstance(self.source_table.c[key].type, Integer) else str
+        written = 0
+        while since < until:
+            with self.source.connect() as connection:
+                logged = connection.execute(
+                    select(changes.c.seq, changes.c.row_id)
+                    .where(changes.c.table_name == self.name)
+                    .where(changes.c.seq > since)
+                    .where(changes.c.seq <= until)
+                    .order_by(changes.c.seq)
+                    .limit(self.chunk_size)
+                ).all()
+                if not logged:
+                    break
+                # The change log only has the first column of the primary key, rows are compared by all of them
+                ids = {cast(row_id) for _, row_id in logged}
+                source_rows = self.read(
+                    connection, self.source_table, self.source_table.c[key].in_(ids)
+                )
+            since = logged[-1].seq
+            with self.dest.begin() as connection:
+                dest_rows = self.read(
+                    connection, self.dest_table, self.dest_table.c[key].in_(ids)
+                )
+                written += self.apply(connection, source_rows, dest_rows)
+                store_mark(connection, self.name, since)
+            print(f'{self.name}: replayed the changes up to {since}')
+        # Also when there was nothing to replay, like on the first sync, which copies the table as it is
+        with self.dest.begin() as connection:
+            store_mark(connection, self.name, until)
+        return written
+
+    def boundary(self, previous: tuple):
+        """Returns the key of the last row of the chunk after the given key, None if it is the last chunk"""
+        table = self.source_table
+        with self.source.connect() as connection:
+            row = connection.execute(
+                select(*(table.c[k] for k in self.keys))
+                .where(self.after(table, previous))
+                .order_by(*(table.c[k] for k in self.keys))
+                .offset(self.chunk_size - 1)
+                .limit(1)
+            ).first()
+        return None if row is None else tuple(row)
+
+    def within(self, table, previous: tuple, last: tuple) -> list:
+        """Returns the conditions for rows after the key `previous`, up to and including the key `last`"""
+        where = [self.after(table, previous)]
+        # The last chunk also covers any rows which only the destination has after it
+        if last is not None:
+            where.append(~self.after(table, last))
+        return where
+
+    def aggregate(self, connection, table, where: list):
+        """
+        Function to compute a checksum of a chunk in the database, so that its rows don't have to be read
+        :return: The number of rows and their checksum, None if the database can't compute one
+        """
+        if self.dialect not in ('mysql', 'postgresql'):
+            return None
+        # NULL is told apart from an empty string
+        text = func.concat_ws(
+            '|', *(func.coalesce(cast(table.c[c], String), '\\N') for c in self.columns)
+        )
+        if self.dialect == 'mysql':
+            digest = func.bit_xor(func.crc32(text))
+        else:
+            from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+            digest = func.md5(
+                func.string_agg(
+                    text,
+                    aggregate_order_by(literal(','), *(table.c[k] for k in self.keys)),
+                )
+            )
+        return tuple(
+            connection.execute(select(func.count(), digest).where(*where)).one()
+        )
+
+    def verify(self, repair: bool) -> (int, int, int):
+        """
+        Function to compare the table in the source and the destination, a chunk at a time
+
+        On MySQL and Postgres, chunks are compared by checksums computed by the databases, and only the rows of chunks
+        which differ are read. Elsewhere every row is read and compared
+        :param repair: Whether to fix the chunks which differ
+        :return: The number of chunks compared, the number which differed, and the number of rows written
+        """
+        chunks = differed = written = 0
+        previous = None
+        while True:
+            last = self.boundary(previous)
+            chunks += 1
+            with self.source.connect() as connection:
+                source_sum = self.aggregate(
+                    connection,
+                    self.source_table,
+                    self.within(self.source_table, previous, last),
+                )
+            with self.dest.connect() as connection:
+                dest_sum = self.aggregate(
+                    connection,
+                    self.dest_table,
+                    self.within(self.dest_table, previous, last),
+                )
+            if source_sum is None or source_sum != dest_sum:
+                with self.source.connect() as connection:
+                    source_rows = self.read(
+                        connection,
+                        self.source_table,
+                        *self.within(self.source_table, previous, last),
+                    )
+                with self.dest.begin() as connection:
+                    dest_rows = self.read(
+                        connection,
+                        self.dest_table,
+                        *self.within(self.dest_table, previous, last),
+                    )
+                    if checksum(source_rows) != checksum(dest_rows):
+                        differed += 1
+                        if repair:
+                            written += self.apply(connection, source_rows, dest_rows)
+            if last is None:
+                return chunks, differed, written
+            previous = last
+
+
+def checksum(rows: dict) -> str:
+    """Returns a checksum of rows read by `TableSync.read()`, regardless of the order the database returned them in"""
+    digest = hashlib.sha1()
+    for key in sorted(rows):
+        digest.update(repr(list(map(normalize, rows[key].values()))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def store_mark(connection, name: str, seq: int):
+    """Records the sequence number of the change log a table was synced up to"""
+    result = connection.execute(
+        sync_marks.update().where(sync_marks.c.table_name == name).values(seq=seq)
+    )
+    if result.rowcount == 0:
+        connection.execute(sync_marks.insert().values(table_name=name, seq=seq))
+
+
+def sync_table(source, dest, source_table, dest_table, chunk_size, check) -> bool:
+    """
+    Function to bring a table in the destination up to date, see the top of this module
+    :return: Whether the table matched, or was made to match, the source
+    """
+    table_sync = TableSync(source, dest, source_table, dest_table, chunk_size)
+    name = table_sync.name
+    new = replayed = 0
+    if not check:
+        logged = inspect(source).has_table(Change.__tablename__)
+        if logged:
+            with source.connect() as connection:
+                until = settled_seq(connection, name)
+            with dest.connect() as connection:
+                since = connection.execute(
+                    select(sync_marks.c.seq).where(sync_marks.c.table_name == name)
+                ).scalar()
+                # Everything logged so far is about to be copied as new rows, or while verifying
+                if (
+                    since is None
+                    and connection.execute(select(dest_table).limit(1)).first() is None
+                ):
+                    since = until
+        new = table_sync.copy_new()
+        if logged:
+            replayed = table_sync.replay(since or 0, until)
+    chunks, differed, repaired = table_sync.verify(repair=not check)
+    status = 'checksums match'
+    if differed:
+        status = f'{differed} of {chunks} chunks differed'
+        if not check:
+            # Values the destination stores differently, or rows written to the source meanwhile, still differ
+            _, differed, _ = table_sync.verify(repair=False)
+            status += f', fixed {repaired} rows'
+            if differed:
+                status += f', {differed} chunks still differ'
+    print(f'{name}: {new} new rows, {replayed} changed rows, {status}')
+    return not differed
+
+
+def sync_database(
+    dest_url: str,
+    source_url: str = None,
+    names: list = None,
+    chunk_size: int = CLONE_CHUNK_SIZE,
+    workers: int = CLONE_WORKERS,
+    check: bool = False,
+) -> bool:
+    """
+    Function to bring a copy of a database up to date, creating tables which it doesn't have yet
+    :param dest_url: URL of the database to copy to
+    :param source_url: URL of the database to copy from, defaults to that of the application
+    :param names: Names of the tables to sync, defaults to all of them
+    :param chunk_size: Number of rows read and written at a time
+    :param workers: Number of tables synced in parallel
+    :param check: Only compare the checksums of the tables, without writing anything
+    :return: Whether every table matches the source
+    :raises CloneError: if a table doesn't exist in the source
+    """
+    source = create_engine(source_url) if source_url else db.engine
+    dest = create_engine(dest_url)
+    # SQLite only allows one writer at a time
+    if dest.dialect.name == 'sqlite':
+        workers = 1
+
+    if names is None:
+        names = [
+            name
+            for name in inspect(source).get_table_names()
+            if name != sync_marks.name
+        ]
+    source_tables, dest_tables = get_tables(source, names)
+    levels = dependency_levels(dest_tables)
+    if check:
+        missing = set(names) - set(inspect(dest).get_table_names())
+        if missing:
+            print(
+                f'Tables {", ".join(sorted(missing))} do not exist in the destination'
+            )
+            return False
+    else:
+        sync_marks.create(dest, checkfirst=True)
+        for level in levels:
+            for name in level:
+                dest_tables[name].create(dest, checkfirst=True)
+    # The destination may have been created by an older version of the models, so it is read as it is
+    reflected = MetaData()
+    reflected.reflect(bind=dest, only=names)
+
+    matched = True
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        for level in levels:
+            futures = [
+                executor.submit(
+                    sync_table,
+                    source,
+                    dest,
+                    source_tables[name],
+                    reflected.tables[name],
+                    chunk_size,
+                    check,
+                )
+                for name in level
+            ]
+            # Tables of the next level reference these, so they have to be done first
+            matched = all([future.result() for future in futures]) and matched
+    if not check:
+        # The copied rows were written without the ID counters
+        with dest.begin() as connection:
+            seed_id_counters(connection, reflected.tables)
+    return matched
@@ -1,48 +1,276 @@
-from urllib3 import PoolManager
-from urllib3.exceptions import ProtocolError
+import atexit
+import os
+import re
+import time
+from collections import deque
+from json import loads
+from threading import Condition, Lock, Thread
 
-# Initialize PoolManager
-manager = PoolManager()
+from urllib3 import PoolManager, Timeout
+from urllib3.exceptions import HTTPError
+
+# Initialize PoolManager, retries are handled by TG itself
+manager = PoolManager(retries=False)
+
+
+class TokenBucket:
+    """
+    Class to limit the rate of an action
+
+    Allows `rate` actions per second on average, with bursts of up to `capacity` actions
+
+    -> acquire: blocks until the action is allowed
+    -> pause: disallows the action for the given number of seconds
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class CircuitBreaker:
+    """
+    Class to stop calling a service that is down
+
+    After `threshold` consecutive failures the circuit opens, and calls are not allowed for `cooldown` seconds. After
+    that a single trial call is allowed (half open), and its outcome closes the circuit or opens it again
+
+    -> allow: returns whether a call may be made now
+    -> record_success / record_failure: report the outcome of a call
+    -> state: closed, open or half_open
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half_open'
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class LatencyHistogram:
+    """Class to count durations into cumulative buckets, in seconds"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.lock = Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.total += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    self.counts[i] += 1
+                    return
+            self.counts[-1] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            buckets = {}
+            count = 0
+            for bound, n in zip((*self.BUCKETS, '+Inf'), self.counts):
+                count += n
+                buckets[str(bound)] = count
+            return {'buckets': buckets, 'count': count, 'sum': round(self.total, 3)}
 
 
 class TG:
     """
     Class to handle our telegram sending
 
-    Has one attribute
+    Has one required attribute
 
     -> api_key: A Telegram bot API key
 
+    The rest tune how we treat the Telegram API
+
+    -> connect_timeout, read_timeout: seconds to wait for a connection and for a response
+    -> chat_rate, chat_burst: messages per second allowed to a single chat, and how many may be sent at once
+    -> max_retry_after: longest flood control wait (`retry_after` of a 429) that we sit out before retrying
+    -> failure_threshold, cooldown: consecutive failures after which sends are skipped, and for how many seconds
+
     Has various functions
 
     -> send: sends a message to the given `function` on the telegram API
     -> send_message: send(sendMessage)
     -> send_chat_action: send(sendChatAction)
     -> send_document: send(sendDocument)
+    -> stats: returns the circuit breaker state, counters, and latency histograms
     """
 
-    def __init__(self, api_key):
+    def __init__(
+        self,
+        api_key,
+        connect_timeout=3.0,
+        read_timeout=10.0,
+        chat_rate=1.0,
+        chat_burst=3,
+        max_retry_after=30,
+        failure_threshold=5,
+        cooldown=60,
+    ):
         self.api_key = api_key
+        self.timeout = Timeout(connect=connect_timeout, read=read_timeout)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retry_after = max_retry_after
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.buckets = {}
+        self.histograms = {}
+        self.counters = {
+            'sent': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'short_circuited': 0,
+        }
+        self.lock = Lock()
+
+    def bucket(self, chat_id) -> TokenBucket:
+        with self.lock:
+            if chat_id not in self.buckets:
+                self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return self.buckets[chat_id]
+
+    def observe(self, function, seconds):
+        with self.lock:
+            if function not in self.histograms:
+                self.histograms[function] = LatencyHistogram()
+            histogram = self.histograms[function]
+        histogram.observe(seconds)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    @staticmethod
+    def retry_after(response) -> int:
+        """Returns the number of seconds Telegram wants us to wait, from the body of a 429 response"""
+        try:
+            return int(loads(response.data)['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return 1
 
     def send(self, function, data):
         # Silently return incase we haven't set an API key
         if self.api_key is None:
             return
-        try:
-            return manager.request(
-                'POST',
-                f'https://api.telegram.org/bot{self.api_key}/{function}',
-                fields=data,
-            )
-        except ProtocolError as e:
-            print(e, e.__class__)
+        # Don't even try while Telegram seems to be down
+        if not self.breaker.allow():
+            self.count('short_circuited')
+            return
+        bucket = self.bucket(data.get('chat_id'))
+        while True:
+            bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = manager.request(
+                    'POST',
+                    f'https://api.telegram.org/bot{self.api_key}/{function}',
+                    fields=data,
+                    timeout=self.timeout,
+                )
+            except HTTPError as e:
+                self.observe(function, time.monotonic() - start)
+                self.breaker.record_failure()
+                self.count('failed')
+                print(e, e.__class__)
+                return
+            self.observe(function, time.monotonic() - start)
+
+            # Flood control, wait as long as Telegram asks us to and try again
+            if response.status == 429:
+                self.count('rate_limited')
+                self.breaker.record_success()
+                retry_after = self.retry_after(response)
+                bucket.pause(retry_after)
+                if retry_after > self.max_retry_after:
+                    return response
+                continue
+
+            if response.status >= 500:
+                self.breaker.record_failure()
+                self.count('failed')
+            else:
+                self.breaker.record_success()
+                self.count('sent')
+            return response
+
+    def stats(self) -> dict:
+        with self.lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        return {
+            'circuit': self.breaker.state,
+            **counters,
+            'latency': {f: h.snapshot() for f, h in histograms.items()},
+        }
 
     def send_message(self, chat_id, message, parse_mode='HTML'):
         data = {
             'chat_id': chat_id,
             'text': message,
-            'parse_mode': parse_mode,
         }
+        # Without one, the message is sent as plain text
+        if parse_mode is not None:
+            data['parse_mode'] = parse_mode
         return self.send('sendMessage', data)
 
     def send_chat_action(self, chat_id, action):
@@ -56,15 +284,160 @@ class TG:
         self,
         chat_id,
         caption,
-        file_name,
+        document,
         disable_notifications=False,
         parse_mode='HTML',
+        file_name='document',
     ):
+        # `document` is either the contents of the file, or the path to it
+        if isinstance(document, str):
+            file_name = document
+            with open(document, 'rb') as f:
+                document = f.read()
         data = {
             'caption': caption,
             'chat_id': chat_id,
-            'document': (file_name, open(file_name, 'rb').read()),
+            'document': (file_name, document),
             'disable_notification': disable_notifications,
             'parse_mode': parse_mode,
         }
         return self.send('sendDocument', data)
+
+
+def truncate_html(text: str, length: int) -> str:
+    """
+    Function to shorten a message formatted with Telegram's HTML, keeping it valid
+    :param text: The message
+    :param length: Maximum length of the result
+    :return: The message, cut before any tag or entity it would split and with the tags left open closed again
+    """
+    if len(text) <= length:
+        return text
+    # Room for closing the tags, which Telegram doesn't nest deeply
+    text = text[: length - 64]
+    for start, end in (('<', '>'), ('&', ';')):
+        if text.rfind(start) > text.rfind(end):
+            text = text[: text.rfind(start)]
+    open_tags = []
+    for closing, tag in re.findall(r'<(/?)([a-zA-Z-]+)[^>]*>', text):
+        if not closing:
+            open_tags.append(tag)
+        elif tag in open_tags:
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag)]
+    return text + ''.join(f'</{tag}>' for tag in reversed(open_tags))
+
+
+class LogSink:
+    """
+    Class to send log messages to a Telegram chat without blocking the caller
+
+    Messages are buffered in memory and sent by a background thread, which joins them into as few `sendMessage`
+    calls as Telegram's 4096 character limit allows. A batch is sent once `flush_size` characters are waiting, or
+    `flush_interval` seconds after the first message of the batch arrived. When `max_size` messages are waiting,
+    further messages are dropped, and the number of dropped messages is reported in the next batch
+
+    -> put: queues a message
+    -> flush: sends everything that is waiting, on the calling thread
+    -> stats: returns the queue depth and counters
+    """
+
+    MAX_LENGTH = 4096
+
+    def __init__(self, tg, chat_id, max_size=1000, flush_interval=2.0, flush_size=3072):
+        self.tg = tg
+        self.chat_id = chat_id
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.queue = deque()
+        self.queued_length = 0
+        self.condition = Condition()
+        self.thread = None
+        self.pid = None
+        self.counters = {
+            'enqueued': 0,
+            'dropped': 0,
+            'sent': 0,
+            'failed': 0,
+            'batches': 0,
+        }
+        self.unreported_drops = 0
+
+    def put(self, message):
+        # Silently return incase we don't have anywhere to log to
+        if self.tg.api_key is None or self.chat_id is None:
+            return
+        message = truncate_html(str(message), self.MAX_LENGTH)
+        with self.condition:
+            if len(self.queue) >= self.max_size:
+                self.counters['dropped'] += 1
+                self.unreported_drops += 1
+                return
+            self.queue.append(message)
+            self.queued_length += len(message) + 1
+            self.counters['enqueued'] += 1
+            self.start()
+            if self.queued_length >= self.flush_size:
+                self.condition.notify()
+
+    def start(self):
+        # The thread is started on first use, so that every forked worker gets its own
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = Thread(target=self.run, name='log-sink', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def take_batches(self) -> list:
+        """Empties the queue, returning its messages joined into (text, number of messages) that Telegram accepts"""
+        batches = []
+        text = ''
+        count = 0
+        if self.unreported_drops:
+            text = f'<b>Hades</b>: {self.unreported_drops} log messages were dropped'
+            self.unreported_drops = 0
+        while self.queue:
+            message = self.queue.popleft()
+            if text and len(text) + len(message) + 1 > self.MAX_LENGTH:
+                batches.append((text, count))
+                text = ''
+                count = 0
+            text = f'{text}\n{message}' if text else message
+            count += 1
+        if text:
+            batches.append((text, count))
+        self.queued_length = 0
+        return batches
+
+    def send(self, batches: list):
+        for text, count in batches:
+            response = self.tg.send_message(self.chat_id, text)
+            if response is not None and response.status == 400:
+                # Telegram rejects the whole batch over a single malformed message, so it is sent as plain text
+                response = self.tg.send_message(self.chat_id, text, parse_mode=None)
+            with self.condition:
+                if response is None or response.status >= 400:
+                    self.counters['failed'] += count
+                else:
+                    self.counters['sent'] += count
+                    self.counters['batches'] += 1
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                self.condition.wait_for(
+                    lambda: self.queued_length >= self.flush_size, self.flush_interval
+                )
+                batches = self.take_batches()
+            self.send(batches)
+
+    def flush(self):
+        with self.condition:
+            batches = self.take_batches()
+        self.send(batches)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {'queued': len(self.queue), **self.counters}
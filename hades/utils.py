@@ -1,34 +1,30 @@
 import base64
+import csv
+import time
+import zlib
+from functools import lru_cache
+from io import BytesIO, StringIO
 from json import dumps
+from threading import Lock
+from typing import List, NamedTuple, Union
 
-import qrcode
-from cryptography.fernet import Fernet
 from decouple import config
-from flask import request
+from flask import g, has_request_context, request
 from flask_login import current_user
 from flask_sqlalchemy.model import Model
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Attachment, Content, Mail
-from sqlalchemy import desc
+from sqlalchemy import exists, select
 from sqlalchemy.exc import IntegrityError
 
-from .models.codex import CodexApril2019, RSC2019, CodexDecember2019, BOV2020
-from .models.csi import CSINovember2019, CSINovemberNonMember2019
+from . import db
+from .models.change import Change
+from .models.contact import Contact, ContactSource
 from .models.event import Events
-from .models.giveaway import Coursera2020
-from .models.techo import EHJuly2019, P5November2019
-from .models.test import TestTable
+from .models.outbox import Outbox
 from .models.user import Users, TSG
 from .models.user_access import Access
-from .models.workshop import (
-    CPPWSMay2019,
-    CCPPWSAugust2019,
-    Hacktoberfest2019,
-    CNovember2019,
-    BitgritDecember2019,
-)
+from .registry import ModelRegistry
 
-from .telegram import TG
+from .telegram import TG, LogSink
 
 from .db_utils import *
 
@@ -36,35 +32,81 @@ from .db_utils import *
 SENDGRID_API_KEY = config('SENDGRID_API_KEY')
 
 # Initialize object for sending messages to telegram
-tg = TG(config('BOT_API_KEY', default=None))
+tg = TG(
+    config('BOT_API_KEY', default=None),
+    connect_timeout=config('TG_CONNECT_TIMEOUT', default=3.0, cast=float),
+    read_timeout=config('TG_READ_TIMEOUT', default=10.0, cast=float),
+    chat_rate=config('TG_CHAT_RATE', default=1.0, cast=float),
+    chat_burst=config('TG_CHAT_BURST', default=3, cast=int),
+    max_retry_after=config('TG_MAX_RETRY_AFTER', default=30, cast=int),
+    failure_threshold=config('TG_FAILURE_THRESHOLD', default=5, cast=int),
+    cooldown=config('TG_COOLDOWN', default=60, cast=int),
+)
 
 # Retrieve ID of Telegram log channel
 log_channel = config('LOG_ID', default=None)
 
-# Create fernet object using secret key
-fernet = Fernet(config('FERNET_KEY'))
-
-DATABASE_CLASSES = {
-    'codex_april_2019': CodexApril2019,
-    'eh_july_2019': EHJuly2019,
-    'cpp_workshop_may_2019': CPPWSMay2019,
-    'rsc_2019': RSC2019,
-    'c_cpp_workshop_august_2019': CCPPWSAugust2019,
-    'do_hacktoberfest_2019': Hacktoberfest2019,
-    'csi_november_2019': CSINovember2019,
-    'csi_november_non_member_2019': CSINovemberNonMember2019,
-    'p5_november_2019': P5November2019,
-    'c_november_2019': CNovember2019,
-    'bitgrit_december_2019': BitgritDecember2019,
-    'test_users': TestTable,
-    'access': Access,
-    'users': Users,
-    'events': Events,
-    'codex_december_2019': CodexDecember2019,
-    'bov_2020': BOV2020,
-    'coursera_2020': Coursera2020,
-    'tsg': TSG,
-}
+# Log messages are buffered and sent to the log channel in batches by a background thread
+log_sink = LogSink(
+    tg,
+    log_channel,
+    max_size=config('LOG_QUEUE_SIZE', default=1000, cast=int),
+    flush_interval=config('LOG_FLUSH_INTERVAL', default=2.0, cast=float),
+    flush_size=config('LOG_FLUSH_SIZE', default=3072, cast=int),
+)
+
+# Models of the tables, imported when they are first used
+DATABASE_CLASSES = ModelRegistry(
+    {
+        'codex_april_2019': 'codex:CodexApril2019',
+        'eh_july_2019': 'techo:EHJuly2019',
+        'cpp_workshop_may_2019': 'workshop:CPPWSMay2019',
+        'rsc_2019': 'codex:RSC2019',
+        'c_cpp_workshop_august_2019': 'workshop:CCPPWSAugust2019',
+        'do_hacktoberfest_2019': 'workshop:Hacktoberfest2019',
+        'csi_november_2019': 'csi:CSINovember2019',
+        'csi_november_non_member_2019': 'csi:CSINovemberNonMember2019',
+        'p5_november_2019': 'techo:P5November2019',
+        'c_november_2019': 'workshop:CNovember2019',
+        'bitgrit_december_2019': 'workshop:BitgritDecember2019',
+        'test_users': 'test:TestTable',
+        'access': 'user_access:Access',
+        'users': 'user:Users',
+        'events': 'event:Events',
+        'codex_december_2019': 'codex:CodexDecember2019',
+        'bov_2020': 'codex:BOV2020',
+        'coursera_2020': 'giveaway:Coursera2020',
+        'tsg': 'user:TSG',
+    }
+)
+
+# Size in pixels of each box of the QR code, and the width in boxes of the border around it
+QR_BOX_SIZE = config('QR_BOX_SIZE', default=10, cast=int)
+QR_BORDER = config('QR_BORDER', default=4, cast=int)
+
+# Whether PNG encoding should spend more time to produce smaller QR codes
+# The QR codes are always drawn in 1-bit mode, which PIL stores as a two colour palette
+QR_OPTIMIZE = config('QR_OPTIMIZE', default=False, cast=bool)
+
+# Number of rendered QR codes to keep around, so that re-sends don't render them again
+QR_CACHE_SIZE = config('QR_CACHE_SIZE', default=128, cast=int)
+
+# Number of rows fetched from the database at a time while exporting a table
+EXPORT_CHUNK_SIZE = config('EXPORT_CHUNK_SIZE', default=1000, cast=int)
+
+# Seconds for which a worker remembers the events and who has access to them. Changes made through the helpers in
+# `db_utils` are seen right away, this only bounds how long changes made behind their back go unnoticed
+ACCESS_CACHE_TTL = config('ACCESS_CACHE_TTL', default=60, cast=int)
+
+# Tables which decide who has access to what, a change to any of them invalidates the cache
+ACCESS_TABLES = ('access', 'events', 'users')
+
+# Full names of all events, as [generation, time cached, {event name: full name}]
+event_cache = [None, 0, {}]
+
+# Events each user has access to, username -> (generation, time cached, set of event names)
+access_cache = {}
+access_cache_lock = Lock()
 
 QR_BLACKLIST = (
     'paid',
@@ -72,46 +114,308 @@ QR_BLACKLIST = (
 )
 
 
-def users_to_json(users: list) -> list:
-    json_data = []
-    for user in users:
-        user_data = {}
-        for k in user.__table__.columns._data.keys():
-            value = getattr(user, k)
-            if value is not None and value != '':
-                user_data[k] = value
-        json_data.append(user_data)
+# Databases which sort NULL after every other value, the others sort it before
+NULLS_HIGH_DIALECTS = ('oracle', 'postgresql')
+
+
+def select_users(
+    table: Model,
+    fields: list = None,
+    filters: dict = None,
+    order_by: str = None,
+    after_id=None,
+    limit: int = None,
+) -> (list, object):
+    """
+    Function to fetch rows of a table with the projection, filtering, ordering and pagination done by the database
+
+    Pages are found by keyset pagination, so fetching a page is an index range scan however deep into the table it is
+    :param table: The table class
+    :param fields: Names of the columns to be returned, all if None
+    :param filters: Dictionary of column names, mapped to the value they must equal, or a prefix followed by `*`
+    :param order_by: Column to order by, prefixed with `-` for descending order. Defaults to the primary key
+    :param after_id: Primary key of the last row of the previous page
+    :param limit: Maximum number of rows to be returned, all if None
+    :return: List of rows as dictionaries, and the `after_id` of the next page (None on the last page)
+    :raises ValueError: if any of the given columns does not exist
+    """
+    columns = table.__table__.columns
+    key = list(table.__table__.primary_key.columns)[0]
+    for name in (*(fields or []), *(filters or {})):
+        if name not in columns:
+            raise ValueError(f'Column {name} does not exist')
+    selected = [columns[name] for name in fields] if fields else list(columns)
+
+    query = select(*selected, key.label('_key')).select_from(table.__table__)
+    for name, value in (filters or {}).items():
+        if value.endswith('*'):
+            prefix = (
+                value[:-1].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            )
+            query = query.where(columns[name].like(f'{prefix}%', escape='\\'))
+        else:
+            query = query.where(columns[name] == value)
+
+    descending = bool(order_by) and order_by.startswith('-')
+    order_name = order_by.lstrip('-') if order_by else key.name
+    if order_name not in columns:
+        raise ValueError(f'Column {order_name} does not exist')
+    order = columns[order_name]
+
+    if after_id is not None:
+        after_id = key.type.python_type(after_id)
+        if order is key:
+            query = query.where(key < after_id if descending else key > after_id)
+        else:
+            # Continue after the row with the given key, using its value of the column we order by. Comparisons with
+            # NULL are never true, so rows without a value are matched separately, on whichever side the database
+            # sorts them, which keeps the order the one an index on the column is read in
+            value = select(order).where(key == after_id).scalar_subquery()
+            beyond = order < value if descending else order > value
+            tie = key > after_id
+            nulls_high = db.engine.dialect.name in NULLS_HIGH_DIALECTS
+            if descending != nulls_high:
+                # NULLs come last
+                query = query.where(
+                    beyond
+                    | ((order == value) & tie)
+                    | (order.is_(None) & (value.isnot(None) | tie))
+                )
+            else:
+                query = query.where(
+                    beyond
+                    | ((order == value) & tie)
+                    | (value.is_(None) & (order.isnot(None) | tie))
+                )
+    query = query.order_by(order.desc() if descending else order)
+    if order is not key:
+        query = query.order_by(key)
+    if limit is not None:
+        query = query.limit(limit)
+
+    rows = []
+    last = None
+    for row in db.session.execute(query).mappings():
+        last = row['_key']
+        rows.append({name: row[name] for name in row.keys() if name != '_key'})
+    next_id = last if limit is not None and len(rows) == limit else None
+    return rows, next_id
+
+
+def select_contacts(
+    table_names: list, after_id: int = None, limit: int = None
+) -> (list, object):
+    """
+    Function to fetch contacts from the directory who registered for any of the given tables
+
+    Pages are found by keyset pagination on the ID of the contact
+    :param table_names: Names of the tables
+    :param after_id: `next` value of the previous page
+    :param limit: Maximum number of contacts to be returned, all if None
+    :return: List of contacts as dictionaries, and the `after_id` of the next page (None on the last page)
+    """
+    sources = ContactSource.__table__
+    query = (
+        select(Contact.id, Contact.name, Contact.phone)
+        .where(
+            exists()
+            .where(sources.c.contact_id == Contact.id)
+            .where(sources.c.table_name.in_(table_names))
+        )
+        .order_by(Contact.id)
+    )
+    if after_id is not None:
+        query = query.where(Contact.id > int(after_id))
+    if limit is not None:
+        query = query.limit(limit)
+    contacts = {
+        id_: {'name': name, 'phone': phone, 'events': []}
+        for id_, name, phone in db.session.execute(query)
+    }
+    if contacts:
+        for contact_id, table_name in db.session.execute(
+            select(sources.c.contact_id, sources.c.table_name)
+            .where(sources.c.contact_id.in_(contacts))
+            .where(sources.c.table_name.in_(table_names))
+            .order_by(sources.c.table_name)
+        ):
+            contacts[contact_id]['events'].append(table_name)
+    next_id = None
+    if contacts and limit is not None and len(contacts) == limit:
+        next_id = max(contacts)
+    return list(contacts.values()), next_id
+
+
+def last_change(table: Model) -> int:
+    """
+    Function to get the sequence number of the latest change to a table which clients may see
+    :param table: The table class
+    :return: The sequence number, 0 if the table has not changed yet
+    """
+    return settled_seq(db.session.connection(), table.__tablename__)
 
-    return json_data
 
+def get_changes(table: Model, since: int, until: int, limit: int) -> (list, list, int):
+    """
+    Function to get the rows of a table which changed in between two sequence numbers
+
+    A row which changed several times is returned once, in its current state
+    :param table: The table class
+    :param since: Sequence number after which changes are returned
+    :param until: Sequence number up to which changes are returned
+    :param limit: Maximum number of changes to be read
+    :return: List of inserted or updated rows as dictionaries, list of primary keys of deleted rows, and the sequence
+    number of the last change read
+    """
+    changes = db.session.execute(
+        select(Change.seq, Change.row_id, Change.op)
+        .where(Change.table_name == table.__tablename__)
+        .where(Change.seq > since)
+        .where(Change.seq <= until)
+        .order_by(Change.seq)
+        .limit(limit)
+    ).all()
+    if not changes:
+        return [], [], since
+
+    key = list(table.__table__.primary_key.columns)[0]
+    ops = {}
+    for _, row_id, op in changes:
+        ops[key.type.python_type(row_id)] = op
+    deleted = [row_id for row_id, op in ops.items() if op == 'delete']
+    changed = [row_id for row_id, op in ops.items() if op != 'delete']
+    rows = []
+    if changed:
+        query = select(table.__table__).where(key.in_(changed)).order_by(key)
+        rows = [dict(row) for row in db.session.execute(query).mappings()]
+    return rows, deleted, changes[-1].seq
+
+
+def users_to_csv(table: Model, compress: bool = False):
+    """
+    Generator which yields the rows of a table as CSV, a chunk at a time
 
-def users_to_csv(table: Model) -> str:
-    keys = table.__table__.columns._data.keys()
-    ret = ','.join(keys) + '\n'
-    for user in table.query.all():
-        for key in keys:
-            ret += str(user[key]) + ','
-        ret += '\n'
-    return ret
+    Rows are fetched EXPORT_CHUNK_SIZE at a time over a server-side cursor (where the driver supports one), so memory
+    use doesn't grow with the size of the table
+    :param table: The table class
+    :param compress: Whether the CSV should be gzipped
+    """
+    columns = table.__table__.columns
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    # wbits=31 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def flush() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(columns.keys())
+    yield flush()
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            select(*columns).order_by(*table.__table__.primary_key)
+        )
+        for rows in result.partitions(EXPORT_CHUNK_SIZE):
+            writer.writerows(rows)
+            chunk = flush()
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
 
 
 def log(message: str):
-    """Logs the given `message` to our Telegram logging channel"""
+    """Queues the given `message` to be sent to our Telegram logging channel"""
+    # Outside of a request (for example in `hades.worker`) there are no headers to look at
+    if not has_request_context():
+        log_sink.put(f'<b>Hades</b>: {message}')
+        return
     try:
-        app, version = request.headers.get('User-Agent').split('/')
-        tg.send_message(log_channel, f'<b>Hades/{app}/{version}</b>: {message}')
+        app, version = request.headers.get('User-Agent', '').split('/')
+        log_sink.put(f'<b>Hades/{app}/{version}</b>: {message}')
     except ValueError:
         if request.headers.get('Origin') == 'https://charon.thescriptgroup.in':
-            tg.send_message(log_channel, f'<b>Hades/Charon/1.0</b>: {message}')
+            log_sink.put(f'<b>Hades/Charon/1.0</b>: {message}')
         else:
-            tg.send_message(log_channel, f'<b>Hades</b>: {message}')
+            log_sink.put(f'<b>Hades</b>: {message}')
+
+
+def rehash_password(user: Users, password: str):
+    """
+    Function to store the hash of a user's password with the current work factor, if it has a different one
+    :param user: The user, whose password was just checked
+    :param password: The password
+    """
+    if not user.needs_rehash():
+        return
+    user.generate_password_hash(password)
+    success, reason = commit_transaction()
+    if not success:
+        log(f'Could not rehash the password of <code>{user.username}</code> - {reason}')
+
+
+class AccessibleEvent(NamedTuple):
+    name: str
+    full_name: str
+
+
+def access_generation() -> tuple:
+    """Returns the versions of the tables which decide who has access to what, read once per request"""
+    if 'access_generation' not in g:
+        g.access_generation = tuple(sorted(get_versions(list(ACCESS_TABLES)).items()))
+    return g.access_generation
+
+
+def get_event_names() -> dict:
+    """Returns a dictionary of the names of all events, mapped to their full names"""
+    generation = access_generation()
+    with access_cache_lock:
+        cached_generation, cached_at, events = event_cache
+    if (
+        cached_generation == generation
+        and time.monotonic() - cached_at < ACCESS_CACHE_TTL
+    ):
+        return events
+    events = dict(db.session.execute(select(Events.name, Events.full_name)).all())
+    with access_cache_lock:
+        event_cache[:] = [generation, time.monotonic(), events]
+    return events
+
+
+def get_accessible_events(username: str) -> set:
+    """Returns the set of names of the events the given user has access to"""
+    generation = access_generation()
+    with access_cache_lock:
+        cached = access_cache.get(username)
+    if (
+        cached is not None
+        and cached[0] == generation
+        and time.monotonic() - cached[1] < ACCESS_CACHE_TTL
+    ):
+        return cached[2]
+    events = set(
+        db.session.execute(select(Access.event).where(Access.user == username))
+        .scalars()
+        .all()
+    )
+    with access_cache_lock:
+        access_cache[username] = (generation, time.monotonic(), events)
+    return events
+
+
+def get_allowed_events() -> set:
+    """Returns the set of names of the events the current request may access, limited by the API token it used"""
+    events = get_accessible_events(current_user.username)
+    scope = g.get('token_scope')
+    return events if scope is None else events & scope
 
 
 def check_access(table_name: str) -> bool:
     """Returns whether or not the currently logged in user has access to `table_name`"""
-    return Access.query.filter(Access.user == current_user.username).filter(
-        Access.event == table_name
-    )
+    return table_name in get_allowed_events()
 
 
 def get_table_by_name(name: str) -> Model:
@@ -119,19 +423,19 @@ def get_table_by_name(name: str) -> Model:
     return DATABASE_CLASSES.get(name)
 
 
-def get_table_full_name(name: str) -> str:
+def get_table_full_name(name: str) -> Union[str, None]:
     """Returns the full name of the table"""
-    return Events.query.filter(Events.name == name).first().full_name
+    return get_event_names().get(name)
 
 
-def get_accessible_tables():
+def get_accessible_tables() -> List[AccessibleEvent]:
     """Returns the list of tables the currently logged in user can access"""
-    return (
-        Events.query.filter(Users.username == current_user.username)
-        .filter(Users.username == Access.user)
-        .filter(Access.event == Events.name)
-        .all()
-    )
+    accessible = get_allowed_events()
+    return [
+        AccessibleEvent(name, full_name)
+        for name, full_name in get_event_names().items()
+        if name in accessible
+    ]
 
 
 def update_user(id_: int, table: Model, user_data: dict) -> (bool, str):
@@ -196,19 +500,40 @@ def delete_user(id_: int, table_name: str) -> (bool, str):
 
 
 def get_current_id(table: Model) -> int:
-    """Function to return the latest ID based on the database entries. 1 if DB is empty."""
-    try:
-        id_ = table.query.order_by(desc(table.id)).first().id
-    except:
-        id_ = 0
-    return int(id_) + 1
+    """Function to return a new ID for a row of the given table, which no other registration will receive."""
+    return allocate_id(table)
 
 
-def generate_qr(user):
-    """Function to generate and return a QR code based on the given data."""
+def generate_qr(user) -> bytes:
+    """Function to generate and return a QR code based on the given data, as PNG bytes."""
     data = {k: v for k, v in user.__dict__.items() if k not in QR_BLACKLIST}
     data['table'] = user.__tablename__
-    return qrcode.make(base64.b64encode(dumps(data).encode()))
+    return render_qr(base64.b64encode(dumps(data, sort_keys=True).encode()))
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_qr(payload: bytes) -> bytes:
+    """
+    Function to render a QR code in memory
+    :param payload: The data to be encoded in the QR code
+    :return: The QR code as PNG bytes
+    """
+    # Imported here as it pulls in PIL, which only registrations need
+    import qrcode
+
+    qr = qrcode.QRCode(box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(payload)
+    buffer = BytesIO()
+    qr.make_image().save(buffer, optimize=QR_OPTIMIZE)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=None)
+def get_sendgrid_client():
+    """Returns the SendGrid client shared by all mails sent from this worker, created on first use"""
+    from sendgrid import SendGridAPIClient
+
+    return SendGridAPIClient(SENDGRID_API_KEY)
 
 
 def send_mail(
@@ -221,6 +546,8 @@ def send_mail(
     if SENDGRID_API_KEY is None:
         return False
 
+    from sendgrid.helpers.mail import Attachment, Content, Mail
+
     # Create a Content object
     html_content = Content('text/html', content)
 
@@ -240,7 +567,7 @@ def send_mail(
 
     # Actually send the email
     try:
-        SendGridAPIClient(SENDGRID_API_KEY).send(mail)
+        get_sendgrid_client().send(mail)
     except Exception as e:
         log('Exception occurred while sending mail!')
         log(e)
@@ -248,13 +575,61 @@ def send_mail(
     return True
 
 
+def queue_mail(
+    from_user: tuple, to: list, subject: str, content: str, attachments=None
+) -> Outbox:
+    """
+    Function to create an outbox entry for an email, which `hades.worker` sends once it has been committed
+    :param from_user: Sender, as accepted by `send_mail`
+    :param to: List of recipients, as accepted by `send_mail`
+    :param subject: Subject of the email
+    :param content: HTML content of the email
+    :param attachments: List of attachments, as accepted by `send_mail`
+    :return: Outbox object, to be inserted along with the data it belongs to
+    """
+    payload = {
+        'from': from_user,
+        'to': to,
+        'subject': subject,
+        'content': content,
+        'attachments': attachments or [],
+    }
+    return Outbox(kind='mail', payload=dumps(payload))
+
+
+def queue_telegram(chat_id, messages: list, caption=None, document=None) -> Outbox:
+    """
+    Function to create an outbox entry for Telegram notifications, which `hades.worker` sends once it has been committed
+    :param chat_id: Chat the notifications are to be sent to
+    :param messages: List of messages, sent in order
+    :param caption: Caption of the document, sent after the messages
+    :param document: Base64 encoded document, if any
+    :return: Outbox object, to be inserted along with the data it belongs to
+    """
+    payload = {
+        'chat_id': chat_id,
+        'messages': messages,
+        'caption': caption,
+        'document': document,
+    }
+    return Outbox(kind='telegram', payload=dumps(payload))
+
+
+@lru_cache(maxsize=None)
+def get_fernet():
+    """Returns the Fernet object for our secret key, created on first use"""
+    from cryptography.fernet import Fernet
+
+    return Fernet(config('FERNET_KEY'))
+
+
 def encrypt(data: str) -> str:
     """
     Function to encrypt a string using Fernet (symmetric encryption)
     :param data: String to be encrypted
     :return: Encrypted string
     """
-    return fernet.encrypt(data.encode()).decode('utf-8')
+    return get_fernet().encrypt(data.encode()).decode('utf-8')
 
 
 def decrypt(data: str) -> str:
@@ -263,7 +638,7 @@ def decrypt(data: str) -> str:
     :param data: String to be decrypted
     :return: Decrypted string
     """
-    return fernet.decrypt(data.encode()).decode('utf-8')
+    return get_fernet().decrypt(data.encode()).decode('utf-8')
 
 
 def extract_timestamp(data: str) -> int:
@@ -272,4 +647,4 @@ def extract_timestamp(data: str) -> int:
     :param data: The encrypted string
     :return: The timestamp at which it was created
     """
-    return fernet.extract_timestamp(data.encode())
+    return get_fernet().extract_timestamp(data.encode())
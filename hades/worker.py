@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Background worker which drains the outbox
+
+`submit()` only queues the emails and Telegram notifications for a registration, in the same transaction as the
+registration itself. This worker picks up the queued entries and performs them on a thread pool, retrying failures
+with an exponential backoff. In between, it sends bulk mails queued by /api/sendmail, a chunk at a time
+
+Run it alongside the application with
+
+    python -m hades.worker
+"""
+
+import base64
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from json import dumps, loads
+
+from decouple import config
+
+from hades import app, db
+from hades.mail import run_mail_job
+from hades.models.outbox import Outbox
+from hades.utils import log, send_mail, tg
+
+# Number of entries which are sent in parallel
+OUTBOX_THREADS = config('OUTBOX_THREADS', default=4, cast=int)
+
+# Maximum number of entries claimed in one go
+OUTBOX_BATCH_SIZE = config('OUTBOX_BATCH_SIZE', default=20, cast=int)
+
+# Seconds to wait before polling again when the outbox is empty
+OUTBOX_POLL_INTERVAL = config('OUTBOX_POLL_INTERVAL', default=1.0, cast=float)
+
+# An entry is given up on after these many attempts
+OUTBOX_MAX_ATTEMPTS = config('OUTBOX_MAX_ATTEMPTS', default=8, cast=int)
+
+# Retry delays start at OUTBOX_BACKOFF seconds and double on every attempt, up to OUTBOX_MAX_BACKOFF seconds
+OUTBOX_BACKOFF = config('OUTBOX_BACKOFF', default=5, cast=int)
+OUTBOX_MAX_BACKOFF = config('OUTBOX_MAX_BACKOFF', default=3600, cast=int)
+
+# Seconds after which an entry claimed by a worker that died is picked up again
+OUTBOX_LEASE = config('OUTBOX_LEASE', default=300, cast=int)
+
+
+class DeliveryError(Exception):
+    """Raised when an outbox entry could not be delivered and should be retried"""
+
+
+def send_queued_mail(payload: dict):
+    """Sends a mail queued by `utils.queue_mail`"""
+    # JSON has no tuples, while SendGrid expects (email, name) tuples
+    from_user = payload['from']
+    if isinstance(from_user, list):
+        from_user = tuple(from_user)
+    to = [tuple(t) if isinstance(t, list) else t for t in payload['to']]
+    if not send_mail(
+        from_user, to, payload['subject'], payload['content'], payload['attachments']
+    ):
+        raise DeliveryError(f"Could not send mail to {payload['to']}")
+
+
+def send_queued_telegram(payload: dict):
+    """
+    Sends the notifications queued by `utils.queue_telegram`
+
+    The number of steps done is kept in `payload['sent']`, so that a retry resumes from the first step which failed
+    instead of posting the earlier messages again
+    """
+    # Nothing to do if Telegram has not been configured
+    if tg.api_key is None:
+        return
+    chat_id = payload['chat_id']
+    steps = [lambda: tg.send_chat_action(chat_id, 'typing')]
+    for message in payload['messages']:
+        steps.append(lambda message=message: tg.send_message(chat_id, message))
+    if payload['document'] is not None:
+        steps.append(
+            lambda: tg.send_document(
+                chat_id,
+                payload['caption'],
+                base64.b64decode(payload['document']),
+                file_name='qr.png',
+            )
+        )
+    elif payload['caption'] is not None:
+        steps.append(lambda: tg.send_message(chat_id, payload['caption']))
+    for step in steps[payload.get('sent', 0) :]:
+        response = step()
+        if response is None or response.status >= 400:
+            raise DeliveryError(f'Could not send Telegram notifications to {chat_id}')
+        payload['sent'] = payload.get('sent', 0) + 1
+
+
+HANDLERS = {
+    'mail': send_queued_mail,
+    'telegram': send_queued_telegram,
+}
+
+
+def deliver(kind: str, payload: dict):
+    """
+    Performs a single outbox entry, raising an exception on failure
+    Handlers may record their progress in `payload`, which is saved along with the retry
+    """
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        raise DeliveryError(f'Unknown outbox entry kind {kind}')
+    handler(payload)
+
+
+def claim_entries() -> list:
+    """
+    Claims the entries which are due, so that other workers skip them
+    :return: List of (id, kind, payload) of the claimed entries
+    """
+    now = datetime.utcnow()
+    entries = (
+        Outbox.query.filter(Outbox.status.in_(('pending', 'sending')))
+        .filter(Outbox.next_attempt_at <= now)
+        .order_by(Outbox.id)
+        .limit(OUTBOX_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for entry in entries:
+        entry.status = 'sending'
+        entry.next_attempt_at = now + timedelta(seconds=OUTBOX_LEASE)
+    claimed = [(entry.id, entry.kind, entry.payload) for entry in entries]
+    db.session.commit()
+    return claimed
+
+
+def record_result(entry_id: int, error, payload: dict):
+    """Marks an entry as sent, or schedules a retry with the progress in `payload` if `error` is set"""
+    entry = Outbox.query.get(entry_id)
+    if error is None:
+        entry.status = 'sent'
+        entry.sent_at = datetime.utcnow()
+        return
+    entry.payload = dumps(payload)
+    entry.attempts += 1
+    entry.last_error = repr(error)
+    if entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+        entry.status = 'failed'
+        log(f'Giving up on outbox entry <code>{entry}</code> - {error}')
+        return
+    delay = min(OUTBOX_BACKOFF * 2 ** (entry.attempts - 1), OUTBOX_MAX_BACKOFF)
+    entry.status = 'pending'
+    entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def drain(executor: ThreadPoolExecutor) -> int:
+    """
+    Claims one batch of due entries and delivers them on the given executor
+    :return: Number of entries processed
+    """
+    claimed = claim_entries()
+    payloads = {entry_id: loads(payload) for entry_id, kind, payload in claimed}
+    futures = {
+        entry_id: executor.submit(deliver, kind, payloads[entry_id])
+        for entry_id, kind, payload in claimed
+    }
+    # Database access stays on this thread, the pool only talks to SendGrid and Telegram
+    for entry_id, future in futures.items():
+        record_result(entry_id, future.exception(), payloads[entry_id])
+    db.session.commit()
+    return len(claimed)
+
+
+def main():
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    with app.app_context(), ThreadPoolExecutor(OUTBOX_THREADS) as executor:
+        while running:
+            try:
+                processed = drain(executor)
+                # Bulk mails go one chunk at a time, so that registrations aren't held up behind them
+                mailed = run_mail_job()
+            except Exception as e:
+                db.session.rollback()
+                print(e, e.__class__)
+                processed = mailed = 0
+            if processed < OUTBOX_BATCH_SIZE and not mailed:
+                time.sleep(OUTBOX_POLL_INTERVAL)
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main()
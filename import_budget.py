@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Checks that importing hades stays cheap, for every gunicorn worker and CLI script that does so
+
+Runs the imports of the package and of each CLI script in a fresh interpreter with `python -X importtime`, and fails
+if any of them imports a module which should only be imported on first use, or takes longer than the budget
+"""
+
+import ast
+import subprocess
+import sys
+from pathlib import Path
+
+from decouple import config
+
+# Cumulative import time allowed, in milliseconds. The best of IMPORT_BUDGET_RUNS runs is compared against it
+IMPORT_BUDGET_MS = config('IMPORT_BUDGET_MS', default=1000, cast=int)
+IMPORT_BUDGET_RUNS = config('IMPORT_BUDGET_RUNS', default=3, cast=int)
+
+# Modules which are only needed by some code paths, and must not be imported up front
+LAZY_MODULES = ('qrcode', 'PIL', 'sendgrid', 'cryptography', 'requests')
+
+SCRIPTS = (
+    'batch_grant.py',
+    'db_setup.py',
+    'grant_all.py',
+    'manage_events.py',
+    'reset_password.py',
+    'user_access.py',
+)
+
+ROOT = Path(__file__).parent
+
+
+def script_imports(script: str) -> str:
+    """Returns the import statements of a script, which can be run without running the script itself"""
+    source = (ROOT / script).read_text()
+    return '\n'.join(
+        ast.get_source_segment(source, node)
+        for node in ast.parse(source).body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def measure(code: str) -> (int, set):
+    """
+    Function to run the given code in a fresh interpreter
+    :return: Cumulative import time in microseconds, and the names of the top level packages imported
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.splitlines()[-1])
+    total = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        # Top level imports aren't indented, their cumulative times add up to the total
+        if not name.startswith('  '):
+            total += int(cumulative)
+        packages.add(name.strip().split('.')[0])
+    return total, packages
+
+
+def main() -> int:
+    failed = False
+    targets = {'hades': 'import hades'}
+    targets.update((script, script_imports(script)) for script in SCRIPTS)
+    for target, code in targets.items():
+        runs = [measure(code) for _ in range(IMPORT_BUDGET_RUNS)]
+        total = min(t for t, _ in runs) / 1000
+        eager = sorted(set(LAZY_MODULES) & runs[0][1])
+        status = 'ok'
+        if eager:
+            status = f'imports {", ".join(eager)}'
+            failed = True
+        elif total > IMPORT_BUDGET_MS:
+            status = f'over the budget of {IMPORT_BUDGET_MS} ms'
+            failed = True
+        print(f'{target}: {total:.0f} ms, {status}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
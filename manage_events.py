@@ -1,13 +1,34 @@
 #!/usr/bin/env python3
 
+from json import loads
 from sys import stdin, stdout, exit
 
 from hades import db
+from hades.db_utils import commit_transaction
 from hades.models.event import Events
+from hades.registry import build_model
 
 
 def send_help():
-    print('Enter to continue, d to delete, e to edit, h for help, Ctrl C/D to exit')
+    print(
+        'Enter to continue, a to (de)activate, d to delete, e to edit, h for help, Ctrl C/D to exit'
+    )
+
+
+def add_event():
+    """Adds an event whose table is defined by a schema, see `hades.registry.build_model`"""
+    name = input('Enter table name for the new event: ')
+    full_name = input(f'Enter full name for table {name}: ')
+    with open(input(f'Enter path to the JSON schema of table {name}: ')) as f:
+        fields = f.read()
+    # Creates the table, and fails on an invalid schema before the event is added
+    build_model(name, loads(fields))
+    db.session.add(Events(name=name, full_name=full_name, fields=fields))
+    success, reason = commit_transaction()
+    if not success:
+        print(f'Could not add event {name} - {reason}')
+        return
+    print(f'Added event {name}, activate it to take registrations')
 
 
 tables = db.engine.table_names()
@@ -22,12 +43,13 @@ for i in range(len(tables)):
 
 try:
     while True:
-        ch = int(
-            input(
-                'Enter the number of the table you wish to interact with, enter/Ctrl C/D to exit\ntable: '
-            )
+        ch = input(
+            'Enter the number of the table you wish to interact with, n to add an event, enter/Ctrl C/D to exit\ntable: '
         )
-        table = tables[ch - 1]
+        if ch == 'n':
+            add_event()
+            continue
+        table = tables[int(ch) - 1]
         send_help()
         current_event = db.session.query(Events).get(table)
         stdout.write(f'{table} -> ')
@@ -35,13 +57,18 @@ try:
         ch = stdin.read(1)
         if ch == 'h':
             send_help()
+        elif ch == 'a':
+            current_event.active = not current_event.active
+            commit_transaction()
+            state = 'active' if current_event.active else 'inactive'
+            print(f'Marked {table} {state}, workers will notice shortly')
         elif ch == 'd':
             db.session.delete(current_event)
-            db.session.commit()
+            commit_transaction()
             print(f'Deleted {table}')
         elif ch == 'e':
             current_event.full_name = input(f'Enter full name for table {table}: ')
-            db.session.commit()
+            commit_transaction()
             print(f'Updated {table} full name to {current_event.full_name}')
 except EOFError:
     print('Exiting!')
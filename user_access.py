@@ -2,17 +2,14 @@
 
 from sys import stdin, stdout, exit
 
-from sqlalchemy.exc import IntegrityError
-
 from hades import db
+from hades.access import AccessError, grant_access, revoke_access
 from hades.models.event import Events
-from hades.models.user import Users
-from hades.models.user_access import Access
 
 
 def send_help():
     print(
-        'Enter to continue, g to grant access to a user, h for help, Ctrl C/D to exit'
+        'Enter to continue, g to grant access to a user, r to revoke it, h for help, Ctrl C/D to exit'
     )
 
 
@@ -43,18 +40,26 @@ try:
             send_help()
         elif ch == 'g':
             username = input(f'Enter username that needs access to {table}: ')
-            user = db.session.query(Users).get(username)
-            if user is None:
-                print(f'User {username} does not seem to exist!')
+            try:
+                count = grant_access({(username, table)})
+            except AccessError as e:
+                print(e)
                 break
-            access = Access(event=table, user=username)
+            if count == 0:
+                print(f'{username} already has access on {table}')
+            else:
+                print(f'Granted access on {table} to {username}')
+        elif ch == 'r':
+            username = input(f'Enter username whose access to {table} is revoked: ')
             try:
-                db.session.add(access)
-                db.session.commit()
-            except IntegrityError:
-                print('IntegrityError, what did you do!')
+                count = revoke_access({(username, table)})
+            except AccessError as e:
+                print(e)
                 break
-            print(f'Granted access on {table} to {username}')
+            if count == 0:
+                print(f'{username} does not have access on {table}')
+            else:
+                print(f'Revoked access on {table} from {username}')
 except EOFError:
     print('Exiting!')
 except KeyboardInterrupt: